@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the test_framework package.
+
+These do not need a running node. Each benchmark compares the fast paths in
+test_framework against the plain code paths they replace, on synthetic data
+of a configurable size.
+
+Usage: bench_framework.py [--txs N] [--iterations N] [benchmark ...]
+
+If no benchmark is named, all of them are run."""
+
+import argparse
+import decimal
+from io import BytesIO
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from test_framework.authproxy import DEFAULT_CODEC, EncodeDecimal
+from test_framework.key import CECKey, OpenSSLECKey, PythonECKey, get_backend, sign_batch, verify_batch
+from test_framework.messages import (
+    CBlock,
+    CBlockHeader,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    FromBytes,
+    HeaderAndShortIDs,
+    calculate_shortid,
+    hash256,
+    ser_compact_size,
+    ser_uint256,
+    uint256_from_compact,
+)
+from test_framework.script import (
+    CScript,
+    FindAndDelete,
+    OP_CODESEPARATOR,
+    PrecomputedTransactionData,
+    SIGHASH_ALL,
+    SegwitVersion1SignatureHash,
+    SignatureHash,
+)
+
+
+def make_block(num_txs, *, with_witness=True, seed=0):
+    """Build a synthetic block with num_txs transactions of 2 inputs and 2 outputs each."""
+    rng = random.Random(seed)
+    block = CBlock()
+    block.nVersion = 4
+    block.hashPrevBlock = rng.getrandbits(256)
+    block.nTime = 1500000000
+    block.nBits = 0x207fffff
+    for _ in range(num_txs):
+        tx = CTransaction()
+        for _ in range(2):
+            tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), rng.randrange(4)), bytes(rng.getrandbits(8) for _ in range(107)), 0xffffffff))
+            tx.vout.append(CTxOut(rng.randrange(1, 10**8), b"\x76\xa9\x14" + bytes(20) + b"\x88\xac"))
+        if with_witness:
+            for _ in tx.vin:
+                wit = CTxInWitness()
+                wit.scriptWitness.stack = [bytes(72), bytes(33)]
+                tx.wit.vtxinwit.append(wit)
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    return block
+
+
+def make_rpc_responses(num_txs, seed=0):
+    """Build synthetic JSON-RPC responses for getblock (verbosity 2), listunspent and getrawmempool.
+
+    Amounts are formatted the way bvaultd formats them, with 8 decimals."""
+    rng = random.Random(seed)
+
+    def amount():
+        return "%d.%08d" % (rng.randrange(50), rng.randrange(10**8))
+
+    def hexstr(n):
+        return "%0*x" % (2 * n, rng.getrandbits(8 * n))
+
+    def response(result):
+        return ('{"result": %s, "error": null, "id": 1}' % result).encode('utf-8')
+
+    txs = []
+    for _ in range(num_txs):
+        vin = ['{"txid": "%s", "vout": %d, "scriptSig": {"asm": "", "hex": ""}, "txinwitness": ["%s", "%s"], "sequence": 4294967295}' % (hexstr(32), n, hexstr(72), hexstr(33)) for n in range(2)]
+        vout = []
+        for n in range(2):
+            h160 = hexstr(20)
+            vout.append('{"value": %s, "n": %d, "scriptPubKey": {"asm": "OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG", "hex": "76a914%s88ac", "reqSigs": 1, "type": "pubkeyhash"}}' % (amount(), n, h160, h160))
+        txs.append('{"txid": "%s", "hash": "%s", "version": 2, "size": 370, "vsize": 208, "weight": 832, "locktime": 0, "vin": [%s], "vout": [%s], "hex": "%s"}' % (hexstr(32), hexstr(32), ", ".join(vin), ", ".join(vout), hexstr(370)))
+    getblock = '{"hash": "%s", "confirmations": 1, "height": 200, "difficulty": 4.656542373906925e-10, "nTx": %d, "tx": [%s]}' % (hexstr(32), num_txs, ", ".join(txs))
+    unspent = ['{"txid": "%s", "vout": %d, "address": "mxyz", "scriptPubKey": "76a914%s88ac", "amount": %s, "confirmations": %d, "spendable": true, "solvable": true, "safe": true}' % (hexstr(32), rng.randrange(4), hexstr(20), amount(), rng.randrange(1, 100)) for _ in range(num_txs)]
+    mempool = ['"%s"' % hexstr(32) for _ in range(num_txs)]
+    return [
+        ("getblock", response(getblock)),
+        ("listunspent", response("[%s]" % ", ".join(unspent))),
+        ("getrawmempool", response("[%s]" % ", ".join(mempool))),
+    ]
+
+
+def timeit(func, iterations):
+    """Return the best wall-clock time of iterations runs of func, in seconds."""
+    best = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, baseline, optimized):
+    print("{:<44} {:>10.2f} ms {:>10.2f} ms {:>7.2f}x".format(name, baseline * 1000, optimized * 1000, baseline / optimized))
+
+
+def bench_deserialize(args):
+    """CBlock deserialization: BytesIO stream vs. memoryview cursor."""
+    block = make_block(args.txs)
+    data = block.serialize(with_witness=True)
+
+    def stream():
+        CBlock().deserialize(BytesIO(data))
+
+    def view():
+        FromBytes(CBlock(), data)
+
+    assert FromBytes(CBlock(), data).serialize(with_witness=True) == data
+    report("deserialize block ({} txs, {} bytes)".format(args.txs, len(data)), timeit(stream, args.iterations), timeit(view, args.iterations))
+
+
+def bench_ecc(args):
+    """secp256k1 keys: OpenSSLECKey (libssl through ctypes) vs. PythonECKey (secp256k1.py).
+
+    The pure-Python table of multiples of G is built before timing; its
+    one-off cost is reported separately."""
+    if get_backend() is not OpenSSLECKey:
+        print("ecc: skipped, libssl does not support secp256k1")
+        return
+    rng = random.Random(0)
+    num_keys = max(args.txs // 10, 1)
+    secrets = [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(num_keys)]
+    hashes = [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(num_keys)]
+
+    start = time.perf_counter()
+    PythonECKey().set_secretbytes(secrets[0])
+    print("{:<44} {:>10.2f} ms (first PythonECKey only)".format("secp256k1 G table", (time.perf_counter() - start) * 1000))
+
+    def keygen(cls):
+        keys = []
+        for secret in secrets:
+            key = cls()
+            key.set_secretbytes(secret)
+            keys.append(key)
+        return keys
+
+    report("keygen {} keys".format(num_keys), timeit(lambda: keygen(OpenSSLECKey), args.iterations), timeit(lambda: keygen(PythonECKey), args.iterations))
+
+    openssl_keys = keygen(OpenSSLECKey)
+    python_keys = keygen(PythonECKey)
+    for openssl_key, python_key in zip(openssl_keys, python_keys):
+        openssl_key.set_compressed(True)
+        python_key.set_compressed(True)
+    assert [key.get_pubkey() for key in openssl_keys] == [key.get_pubkey() for key in python_keys]
+    report("get_pubkey {} keys".format(num_keys), timeit(lambda: [key.get_pubkey() for key in openssl_keys], args.iterations), timeit(lambda: [key.get_pubkey() for key in python_keys], args.iterations))
+
+    def sign(keys):
+        return [key.sign(h) for key, h in zip(keys, hashes)]
+
+    report("sign {} hashes".format(num_keys), timeit(lambda: sign(openssl_keys), args.iterations), timeit(lambda: sign(python_keys), args.iterations))
+
+    sigs = sign(openssl_keys)
+
+    def verify(keys):
+        return [key.verify(h, sig) for key, h, sig in zip(keys, hashes, sigs)]
+
+    assert all(verify(python_keys))
+    report("verify {} signatures".format(num_keys), timeit(lambda: verify(openssl_keys), args.iterations), timeit(lambda: verify(python_keys), args.iterations))
+
+
+def bench_import(args):
+    """Importing the framework: loading the modules it used to load eagerly vs. on first use.
+
+    Each import is timed in a fresh interpreter. On Python 3.7+, the
+    cumulative import time of each test_framework module is listed as well."""
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code, *options):
+        return subprocess.run([sys.executable] + list(options) + ["-c", code], cwd=here, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def import_time(code):
+        timed = "import time\nstart = time.perf_counter()\n{}\nprint(time.perf_counter() - start)".format(code)
+        return min(float(run(timed).stdout) for _ in range(args.iterations))
+
+    cases = [
+        ("import test_framework.test_framework",
+         # What used to be imported along with test_framework.test_framework
+         "import inspect, multiprocessing, pdb\nimport test_framework.mininode, test_framework.test_framework",
+         "import test_framework.test_framework"),
+        ("import test_framework.key",
+         "import test_framework.key\ntest_framework.key.ssl.BN_new",
+         "import test_framework.key"),
+    ]
+    for name, eager, lazy in cases:
+        report(name, import_time(eager), import_time(lazy))
+
+    if sys.version_info < (3, 7):
+        return
+    stderr = run("import test_framework.test_framework", "-X", "importtime").stderr
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip().startswith("test_framework"):
+            print("  {:<42} {:>10.2f} ms".format(fields[2].rstrip(), int(fields[1]) / 1000))
+
+
+def bench_rpc_json(args):
+    """RPC response decoding: json with an unconditional debug-log dump vs. AuthServiceProxy's codec."""
+    for method, data in make_rpc_responses(args.txs):
+
+        def always_log():
+            # What AuthServiceProxy._get_response() used to do, whether or
+            # not debug logging was enabled.
+            response = json.loads(data.decode('utf8'), parse_float=decimal.Decimal)
+            json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=True)
+            return response
+
+        def codec():
+            return DEFAULT_CODEC.loads(data)
+
+        assert always_log() == codec()
+        report("{} response {} ({} bytes)".format(DEFAULT_CODEC.name, method, len(data)), timeit(always_log, args.iterations), timeit(codec, args.iterations))
+
+
+def bench_segwit_sighash(args):
+    """BIP143 signature hashes of every input of a transaction: hashing the transaction per input vs. once."""
+    num_inputs = args.txs // 4
+    tx = make_block(1).vtx[0]
+    tx.vin *= num_inputs // len(tx.vin)
+    script = CScript(b"\x76\xa9\x14" + bytes(20) + b"\x88\xac")
+
+    def per_input():
+        return [SegwitVersion1SignatureHash(script, tx, i, SIGHASH_ALL, 10**8) for i in range(len(tx.vin))]
+
+    def precomputed():
+        txdata = PrecomputedTransactionData(tx)
+        return [SegwitVersion1SignatureHash(script, tx, i, SIGHASH_ALL, 10**8, txdata) for i in range(len(tx.vin))]
+
+    assert per_input() == precomputed()
+    report("segwit sighash ({} inputs)".format(len(tx.vin)), timeit(per_input, args.iterations), timeit(precomputed, args.iterations))
+
+
+def bench_shortids(args):
+    """BIP 152 shortids of a block: calculate_shortid() per transaction vs. HeaderAndShortIDs' batch.
+
+    The batch uses NumPy if it is installed, and is no faster otherwise."""
+    block = make_block(args.txs * 5)
+    for tx in block.vtx:
+        tx.calc_sha256()
+        tx.calc_sha256(with_witness=True)
+    compact = HeaderAndShortIDs()
+    compact.initialize_from_block(block, use_witness=True)
+    k0, k1 = compact.get_siphash_keys()
+
+    def serial():
+        # What HeaderAndShortIDs.initialize_from_block() used to do
+        return [calculate_shortid(k0, k1, tx.calc_sha256(with_witness=True)) for tx in block.vtx[1:]]
+
+    def batch():
+        compact.initialize_from_block(block, use_witness=True)
+        return compact.shortids
+
+    assert serial() == batch()
+    report("shortids ({} txs)".format(len(block.vtx)), timeit(serial, args.iterations), timeit(batch, args.iterations))
+
+    def serial_map():
+        return {calculate_shortid(k0, k1, tx.calc_sha256(with_witness=True)): tx for tx in block.vtx}
+
+    def batch_map():
+        return compact.get_shortid_map(block.vtx)
+
+    assert serial_map() == batch_map()
+    report("get_shortid_map ({} txs)".format(len(block.vtx)), timeit(serial_map, args.iterations), timeit(batch_map, args.iterations))
+
+
+def bench_sign(args):
+    """ECDSA signing and verification: one signature at a time vs. sign_batch()/verify_batch().
+
+    A quarter of the hashes are signed twice, as when a test re-signs an input."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(args.txs // 2)]
+    hashes += hashes[:len(hashes) // 4]
+
+    def new_key():
+        # A new key each run, so that no run reuses another's cached signatures
+        key = CECKey()
+        key.set_secretbytes(rng.getrandbits(256).to_bytes(32, 'big'))
+        return key
+
+    def serial_sign():
+        key = new_key()
+        return [key.sign(h) for h in hashes]
+
+    def batch_sign():
+        key = new_key()
+        return sign_batch([(key, h) for h in hashes])
+
+    key = new_key()
+    sigs = sign_batch([(key, h) for h in hashes])
+    assert all(key.verify(h, sig) for h, sig in zip(hashes, sigs))
+    # A key that is set to another value must not be signed with its old one
+    changed_key = new_key()
+    for max_workers in (1, 2):
+        sign_batch([(changed_key, h) for h in hashes[:4]], max_workers=max_workers)
+        changed_key.set_secretbytes(rng.getrandbits(256).to_bytes(32, 'big'))
+        changed_sigs = sign_batch([(changed_key, h) for h in hashes[:5]], max_workers=max_workers)
+        assert all(changed_key.verify(h, sig) for h, sig in zip(hashes, changed_sigs))
+        assert verify_batch([(changed_key, h, sig) for h, sig in zip(hashes, changed_sigs)], max_workers=max_workers) == [True] * 5
+    report("sign {} hashes ({} CPUs)".format(len(hashes), os.cpu_count()), timeit(serial_sign, args.iterations), timeit(batch_sign, args.iterations))
+
+    def serial_verify():
+        return [key.verify(h, sig) for h, sig in zip(hashes, sigs)]
+
+    def batch_verify():
+        return verify_batch([(key, h, sig) for h, sig in zip(hashes, sigs)])
+
+    assert serial_verify() == batch_verify()
+    report("verify {} signatures ({} CPUs)".format(len(hashes), os.cpu_count()), timeit(serial_verify, args.iterations), timeit(batch_verify, args.iterations))
+
+
+def bench_serialize(args):
+    """CBlock serialization: repeated bytes concatenation vs. a single bytearray."""
+    for num_txs in sorted({args.txs // 2, args.txs, args.txs * 5}):
+        block = make_block(num_txs)
+
+        def concatenate():
+            # What CBlock.serialize() used to do: grow an immutable bytes
+            # object one transaction at a time.
+            r = CBlockHeader.serialize(block)
+            r += ser_compact_size(len(block.vtx))
+            for tx in block.vtx:
+                r += tx.serialize_with_witness()
+            return r
+
+        def single_buffer():
+            return block.serialize(with_witness=True)
+
+        assert concatenate() == single_buffer()
+        report("serialize block ({} txs)".format(num_txs), timeit(concatenate, args.iterations), timeit(single_buffer, args.iterations))
+
+
+def bench_legacy_sighash(args):
+    """Legacy signature hashes of every input of a transaction: copying it per input vs. splicing into its serialization."""
+    num_inputs = args.txs // 10
+    txs = make_block(num_inputs // 2, with_witness=False).vtx
+    tx = txs[0]
+    tx.vin = [txin for t in txs for txin in t.vin]
+    script = CScript(b"\x76\xa9\x14" + bytes(20) + b"\x88\xac")
+
+    def copy_per_input():
+        # What SignatureHash() used to do for SIGHASH_ALL
+        hashes = []
+        for i in range(len(tx.vin)):
+            txtmp = CTransaction(tx)
+            for txin in txtmp.vin:
+                txin.scriptSig = b''
+            txtmp.vin[i].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
+            hashes.append(hash256(txtmp.serialize_without_witness() + struct.pack("<I", SIGHASH_ALL)))
+        return hashes
+
+    def per_input():
+        return [SignatureHash(script, tx, i, SIGHASH_ALL)[0] for i in range(len(tx.vin))]
+
+    def precomputed():
+        txdata = PrecomputedTransactionData(tx)
+        return [SignatureHash(script, tx, i, SIGHASH_ALL, txdata)[0] for i in range(len(tx.vin))]
+
+    assert copy_per_input() == per_input() == precomputed()
+    baseline = timeit(copy_per_input, args.iterations)
+    report("legacy sighash ({} inputs)".format(len(tx.vin)), baseline, timeit(per_input, args.iterations))
+    report("legacy sighash, shared txdata ({} inputs)".format(len(tx.vin)), baseline, timeit(precomputed, args.iterations))
+
+
+def bench_merkle_root(args):
+    """Merkle roots of a block: freshly deserialized transactions vs. memoized txids/wtxids."""
+    block = make_block(args.txs)
+    data = block.serialize(with_witness=True)
+    fresh_blocks = [FromBytes(CBlock(), data) for _ in range(args.iterations)]
+
+    def fresh():
+        b = fresh_blocks.pop()
+        b.calc_merkle_root()
+        b.calc_witness_merkle_root()
+
+    def memoized():
+        block.calc_merkle_root()
+        block.calc_witness_merkle_root()
+
+    memoized()
+    report("merkle roots ({} txs)".format(args.txs), timeit(fresh, args.iterations), timeit(memoized, args.iterations))
+
+
+def bench_merkle_append(args):
+    """Growing a block one transaction at a time: full merkle recomputation vs. incremental tree."""
+    num_txs = args.txs // 4
+    txs = make_block(num_txs).vtx
+    for tx in txs:
+        tx.rehash()
+
+    def full():
+        hashes = []
+        for tx in txs:
+            hashes.append(ser_uint256(tx.sha256))
+            CBlock.get_merkle_root(hashes)
+
+    def incremental():
+        block = CBlock()
+        for tx in txs:
+            block.append_tx(tx)
+            block.calc_merkle_root()
+
+    report("merkle root per append ({} txs)".format(num_txs), timeit(full, args.iterations), timeit(incremental, args.iterations))
+
+    def witness_full():
+        for i in range(2, len(txs) + 1):
+            CBlock.get_merkle_root([ser_uint256(0)] + [ser_uint256(tx.calc_sha256(True)) for tx in txs[1:i]])
+
+    def witness_incremental():
+        block = CBlock()
+        for tx in txs:
+            block.append_tx(tx)
+            block.calc_witness_merkle_root()
+
+    report("witness root per append ({} txs)".format(num_txs), timeit(witness_full, args.iterations), timeit(witness_incremental, args.iterations))
+
+    # A transaction changed in place after it was added must still change
+    # the witness root
+    block = CBlock()
+    for tx in txs[:8]:
+        block.append_tx(CTransaction(tx))
+    root = block.calc_witness_merkle_root()
+    block.vtx[5].wit.vtxinwit[0].scriptWitness.stack.append(b"\x01")
+    changed_root = block.calc_witness_merkle_root()
+    assert changed_root != root
+    assert changed_root == CBlock.get_merkle_root([ser_uint256(0)] + [ser_uint256(tx.calc_sha256(True)) for tx in block.vtx[1:]])
+    block.vtx[5].wit.vtxinwit[0].scriptWitness.stack.pop()
+    assert block.calc_witness_merkle_root() == root
+
+
+def bench_solve(args):
+    """Block solving at a non-trivial target: rehash() per nonce vs. SHA256 midstate search."""
+    block = CBlock()
+    block.nBits = 0x1f00ffff
+    block.nTime = 1500000000
+
+    def rehash_loop():
+        for prev in range(4):
+            block.hashPrevBlock = prev
+            block.nNonce = 0
+            block.rehash()
+            target = uint256_from_compact(block.nBits)
+            while block.sha256 > target:
+                block.nNonce += 1
+                block.rehash()
+
+    def midstate():
+        for prev in range(4):
+            block.hashPrevBlock = prev
+            block.nNonce = 0
+            block.solve()
+
+    report("solve 4 blocks (nBits={:08x})".format(block.nBits), timeit(rehash_loop, args.iterations), timeit(midstate, args.iterations))
+
+
+BENCHMARKS = {
+    "deserialize": bench_deserialize,
+    "ecc": bench_ecc,
+    "import": bench_import,
+    "legacy_sighash": bench_legacy_sighash,
+    "merkle_append": bench_merkle_append,
+    "merkle_root": bench_merkle_root,
+    "rpc_json": bench_rpc_json,
+    "segwit_sighash": bench_segwit_sighash,
+    "serialize": bench_serialize,
+    "shortids": bench_shortids,
+    "sign": bench_sign,
+    "solve": bench_solve,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, out of: {} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--txs', type=int, default=2000, help='number of transactions in the synthetic block (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=5, help='number of timed runs per benchmark; the best is reported (default: %(default)s)')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(', '.join(sorted(unknown))))
+
+    print("{:<44} {:>13} {:>13} {:>8}".format("benchmark", "baseline", "optimized", "speedup"))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,14 +6,18 @@
 
 from decimal import Decimal
 
-from test_framework.test_framework import BitcoinTestFramework
+from test_framework.test_framework import BitcoinTestFramework, ChainFixture
 from test_framework.util import assert_equal, assert_greater_than, assert_raises_rpc_error, create_confirmed_utxos, create_lots_of_big_transactions, gen_return_txouts
 
+def create_utxos(test):
+    node = test.nodes[0]
+    create_confirmed_utxos(node.getnetworkinfo()['relayfee'], node, 91)
+
 class MempoolLimitTest(BitcoinTestFramework):
     def set_test_params(self):
-        self.setup_clean_chain = True
         self.num_nodes = 1
         self.extra_args = [["-maxmempool=5", "-spendzeroconfchange=0"]]
+        self.chain_fixture = ChainFixture("mempool_limit", create_utxos, num_nodes=1, extra_args=self.extra_args)
 
     def skip_test_if_missing_module(self):
         self.skip_if_no_wallet()
@@ -27,7 +31,8 @@ class MempoolLimitTest(BitcoinTestFramework):
         assert_equal(self.nodes[0].getmempoolinfo()['mempoolminfee'], Decimal('0.00001000'))
 
         txids = []
-        utxos = create_confirmed_utxos(relayfee, self.nodes[0], 91)
+        utxos = self.nodes[0].listunspent()
+        assert(len(utxos) >= 91)
 
         self.log.info('Create a mempool tx that will be evicted')
         us0 = utxos.pop()
@@ -12,7 +12,7 @@ import random
 
 from test_framework.blocktools import create_block, create_coinbase, add_witness_commitment
 from test_framework.messages import BlockTransactions, BlockTransactionsRequest, calculate_shortid, CBlock, CBlockHeader, CInv, COutPoint, CTransaction, CTxIn, CTxInWitness, CTxOut, FromHex, HeaderAndShortIDs, msg_block, msg_blocktxn, msg_cmpctblock, msg_getblocktxn, msg_getdata, msg_getheaders, msg_headers, msg_inv, msg_sendcmpct, msg_sendheaders, msg_tx, msg_witness_block, msg_witness_blocktxn, MSG_WITNESS_FLAG, NODE_NETWORK, NODE_WITNESS, P2PHeaderAndShortIDs, PrefilledTransaction, ser_uint256, ToHex
-from test_framework.mininode import mininode_lock, P2PInterface
+from test_framework.mininode import mininode_lock, P2PCompactBlockReconstructor, P2PInterface
 from test_framework.script import CScript, OP_TRUE, OP_DROP
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal, get_bip9_status, satoshi_round, sync_blocks, wait_until
@@ -91,6 +91,18 @@ class TestP2PConn(P2PInterface):
         self.send_message(message)
         wait_until(lambda: not self.is_connected, timeout=timeout, lock=mininode_lock)
 
+# ReconstructingP2PConn: A peer that reconstructs the compact blocks it is
+# sent from its transaction pool, and records the indexes it requests.
+class ReconstructingP2PConn(P2PCompactBlockReconstructor, P2PInterface):
+    def __init__(self):
+        super().__init__()
+        self.getblocktxn_indexes = []
+
+    def send_message(self, message):
+        if message.command == b"getblocktxn":
+            self.getblocktxn_indexes.append(message.block_txn_request.to_absolute())
+        super().send_message(message)
+
 class CompactBlocksTest(BitcoinTestFramework):
     def set_test_params(self):
         self.setup_clean_chain = True
@@ -791,6 +803,46 @@ class CompactBlocksTest(BitcoinTestFramework):
         stalling_peer.send_and_ping(msg)
         assert_equal(int(node.getbestblockhash(), 16), block.sha256)
 
+    # Test that a peer that has some of a new block's transactions in its pool
+    # reconstructs the block from the node's compact block, requesting exactly
+    # the transactions it doesn't have.
+    def test_compactblock_reconstruction_from_pool(self, node, version):
+        assert(len(self.utxos))
+        peer = node.add_p2p_connection(ReconstructingP2PConn())
+        peer.compact_use_witness = (version == 2)
+        self.request_cb_announcements(peer, node, version)
+
+        utxo = self.utxos.pop(0)
+        txs = self.build_block_with_transactions(node, utxo, 10).vtx[1:]
+        for tx in txs:
+            peer.send_message(msg_tx(tx))
+        peer.sync_with_ping()
+        mempool = node.getrawmempool()
+        for tx in txs:
+            assert(tx.hash in mempool)
+
+        # Withhold every third transaction from the peer's pool
+        withheld = set(tx.sha256 for tx in txs[::3])
+        peer.add_to_tx_pool([tx for tx in txs if tx.sha256 not in withheld])
+
+        block_hash = node.generate(1)[0]
+        block = peer.wait_for_reconstruction(int(block_hash, 16), timeout=30)
+        assert_equal([tx.hash for tx in block.vtx], node.getblock(block_hash)["tx"])
+
+        withheld_indexes = [i for i, tx in enumerate(block.vtx) if tx.sha256 in withheld]
+        assert_equal(len(withheld_indexes), len(withheld))
+        with mininode_lock:
+            assert_equal(peer.getblocktxn_indexes, [withheld_indexes])
+        stats = peer.get_reconstruction_stats()
+        assert_equal(stats["blocks"], 1)
+        assert_equal(stats["getblocktxn"], 1)
+        assert_equal(stats["failed"], 0)
+        assert_equal(stats["missing_tx_rate"], len(withheld) / len(txs))
+
+        peer.peer_disconnect()
+        peer.wait_for_disconnect()
+        self.utxos.append([txs[-1].sha256, 0, txs[-1].vout[0].nValue])
+
     def run_test(self):
         # Setup the p2p connections
         self.test_node = self.nodes[0].add_p2p_connection(TestP2PConn())
@@ -863,6 +915,12 @@ class CompactBlocksTest(BitcoinTestFramework):
         self.test_compactblock_reconstruction_multiple_peers(self.nodes[1], self.segwit_node, self.old_node)
         sync_blocks(self.nodes)
 
+        self.log.info("Testing reconstructing compact blocks from a transaction pool...")
+        self.test_compactblock_reconstruction_from_pool(self.nodes[0], 1)
+        sync_blocks(self.nodes)
+        self.test_compactblock_reconstruction_from_pool(self.nodes[1], 2)
+        sync_blocks(self.nodes)
+
         # Advance to segwit activation
         self.log.info("Advancing to segwit activation")
         self.activate_segwit(self.nodes[1])
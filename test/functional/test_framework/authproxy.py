@@ -26,25 +26,34 @@ ServiceProxy class:
 
 - HTTP connections persist for the life of the AuthServiceProxy object
   (if server supports HTTP/1.1)
+- HTTP connections are pooled, so one AuthServiceProxy can be used to make
+  concurrent calls from several threads
 - sends protocol 'version', per JSON-RPC 1.1
 - sends proper, incrementing 'id'
 - sends Basic HTTP authentication headers
 - parses all JSON numbers that look like floats as Decimal
-- uses standard Python json lib
+- uses standard Python json lib, or another JSONCodec given to it
+- only serializes requests and responses for the debug log if the
+  BitcoinRPC logger is enabled for DEBUG
 """
 
 import base64
 import decimal
 import http.client
+import itertools
 import json
 import logging
 import os
 import socket
+import threading
 import time
 import urllib.parse
 
 HTTP_TIMEOUT = 30
 USER_AGENT = "AuthServiceProxy/0.1"
+# Default number of keep-alive connections per server. bvaultd serves
+# -rpcthreads=4 requests concurrently by default.
+DEFAULT_MAX_CONNECTIONS = 4
 
 log = logging.getLogger("BitcoinRPC")
 
@@ -63,11 +72,74 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+class JSONCodec():
+    """Encodes requests and decodes responses with the standard json module.
+
+    Numbers with a fraction or exponent are decoded as Decimal, and Decimal
+    values are encoded with EncodeDecimal."""
+
+    name = "json"
+
+    def dumps(self, obj, ensure_ascii=True):
+        return json.dumps(obj, default=EncodeDecimal, ensure_ascii=ensure_ascii).encode('utf-8')
+
+    def loads(self, data):
+        # json.loads() only accepts bytes from Python 3.6
+        return json.loads(data.decode('utf8'), parse_float=decimal.Decimal)
+
+DEFAULT_CODEC = JSONCodec()
+
+class ConnectionPool():
+    """A thread-safe pool of keep-alive HTTP connections to one server.
+
+    Connections are opened on demand, up to max_connections, and lent to one
+    caller at a time; acquire() blocks while all of them are lent out. Idle
+    connections are reused most-recently-released first, so a single-threaded
+    user keeps using a single connection."""
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT, max_connections=DEFAULT_MAX_CONNECTIONS, connection=None):
+        self.url = url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._idle = []
+        self._num_connections = 0
+        self._cond = threading.Condition()
+        if connection:
+            # A caller-supplied connection is the only one the pool will use
+            self._idle.append(connection)
+            self._num_connections = 1
+            self.max_connections = 1
+            self.timeout = connection.timeout
+
+    def _new_connection(self):
+        port = 80 if self.url.port is None else self.url.port
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    def acquire(self):
+        with self._cond:
+            while not self._idle and self._num_connections >= self.max_connections:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._num_connections += 1
+        return self._new_connection()
+
+    def release(self, conn):
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+
 class AuthServiceProxy():
-    __id_count = 0
+    __id_counter = itertools.count(1)
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    # max_connections: size of the connection pool, unless connection or pool is given
+    # pool: ConnectionPool to share with another proxy for the same server
+    # codec: JSONCodec to encode requests and decode responses with (default: DEFAULT_CODEC)
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True, *, max_connections=DEFAULT_MAX_CONNECTIONS, pool=None, codec=None):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii  # can be toggled on the fly by tests
@@ -76,8 +148,14 @@ class AuthServiceProxy():
         passwd = None if self.__url.password is None else self.__url.password.encode('utf8')
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
-        self.timeout = timeout
-        self._set_conn(connection)
+        if pool is None:
+            pool = ConnectionPool(self.__url, timeout, max_connections, connection)
+        self._pool = pool
+        self.codec = DEFAULT_CODEC if codec is None else codec
+
+    @property
+    def timeout(self):
+        return self._pool.timeout
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -85,7 +163,7 @@ class AuthServiceProxy():
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return AuthServiceProxy(self.__service_url, name, pool=self._pool, codec=self.codec)
 
     def _request(self, method, path, postdata):
         '''
@@ -96,42 +174,55 @@ class AuthServiceProxy():
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
-        if os.name == 'nt':
-            # Windows somehow does not like to re-use connections
-            # TODO: Find out why the connection would disconnect occasionally and make it reusable on Windows
-            self._set_conn()
+        conn = self._pool.acquire()
+        try:
+            if os.name == 'nt':
+                # Windows somehow does not like to re-use connections
+                # TODO: Find out why the connection would disconnect occasionally and make it reusable on Windows
+                conn.close()
+            return self._request_on(conn, method, path, postdata, headers)
+        except Exception:
+            # Don't hand out a connection in an unknown state; it reconnects
+            # on its next request.
+            conn.close()
+            raise
+        finally:
+            self._pool.release(conn)
+
+    def _request_on(self, conn, method, path, postdata, headers):
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            conn.request(method, path, postdata, headers)
+            return self._get_response(conn)
         except http.client.BadStatusLine as e:
             if e.line == "''":  # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
+                conn.close()
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
             else:
                 raise
         except (BrokenPipeError, ConnectionResetError):
             # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
             # ConnectionResetError happens on FreeBSD with Python 3.4
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            conn.close()
+            conn.request(method, path, postdata, headers)
+            return self._get_response(conn)
 
     def get_request(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        request_id = next(AuthServiceProxy.__id_counter)
 
-        log.debug("-%s-> %s %s" % (AuthServiceProxy.__id_count, self._service_name,
-                                   json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s" % (request_id, self._service_name,
+                                       json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         if args and argsn:
             raise ValueError('Cannot handle both named and positional arguments')
         return {'version': '1.1',
                 'method': self._service_name,
                 'params': args or argsn,
-                'id': AuthServiceProxy.__id_count}
+                'id': request_id}
 
     def __call__(self, *args, **argsn):
-        postdata = json.dumps(self.get_request(*args, **argsn), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+        postdata = self.codec.dumps(self.get_request(*args, **argsn), self.ensure_ascii)
+        response = self._request('POST', self.__url.path, postdata)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -141,21 +232,22 @@ class AuthServiceProxy():
             return response['result']
 
     def batch(self, rpc_call_list):
-        postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        log.debug("--> " + postdata)
-        return self._request('POST', self.__url.path, postdata.encode('utf-8'))
+        postdata = self.codec.dumps(list(rpc_call_list), self.ensure_ascii)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> " + postdata.decode('utf-8'))
+        return self._request('POST', self.__url.path, postdata)
 
-    def _get_response(self):
+    def _get_response(self, conn):
         req_start_time = time.time()
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout:
             raise JSONRPCException({
                 'code': -344,
                 'message': '%r RPC took longer than %f seconds. Consider '
                            'using larger timeout for calls that take '
                            'longer to return.' % (self._service_name,
-                                                  self.__conn.timeout)})
+                                                  conn.timeout)})
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -165,24 +257,16 @@ class AuthServiceProxy():
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
 
-        responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
-        elapsed = time.time() - req_start_time
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- [%.6f] %s" % (response["id"], elapsed, json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
-        else:
-            log.debug("<-- [%.6f] %s" % (elapsed, responsedata))
+        responsedata = http_response.read()
+        response = self.codec.loads(responsedata)
+        if log.isEnabledFor(logging.DEBUG):
+            elapsed = time.time() - req_start_time
+            if "error" in response and response["error"] is None:
+                log.debug("<-%s- [%.6f] %s" % (response["id"], elapsed, json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+            else:
+                log.debug("<-- [%.6f] %s" % (elapsed, responsedata.decode('utf8')))
         return response
 
     def __truediv__(self, relative_uri):
-        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, connection=self.__conn)
-
-    def _set_conn(self, connection=None):
-        port = 80 if self.__url.port is None else self.__url.port
-        if connection:
-            self.__conn = connection
-            self.timeout = connection.timeout
-        elif self.__url.scheme == 'https':
-            self.__conn = http.client.HTTPSConnection(self.__url.hostname, port, timeout=self.timeout)
-        else:
-            self.__conn = http.client.HTTPConnection(self.__url.hostname, port, timeout=self.timeout)
+        # Requests for other paths on the same server can share the pool
+        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, pool=self._pool, codec=self.codec)
@@ -1,5 +1,10 @@
 # Copyright (c) 2011 Sam Rushing
-"""ECC secp256k1 OpenSSL wrapper.
+"""ECC secp256k1 keys, using OpenSSL or pure Python.
+
+CECKey() makes a key of the backend selected with set_backend(): an
+OpenSSLECKey, which wraps OpenSSL's EC_KEY through ctypes, or a PythonECKey,
+which uses the pure-Python implementation in secp256k1.py. By default it uses
+OpenSSL if libssl can be loaded and supports secp256k1.
 
 WARNING: This module does not mlock() secrets; your private keys may end up on
 disk in swap! Use with caution!
@@ -8,64 +13,87 @@ This file is modified from python-bitcoinlib.
 """
 
 import ctypes
-import ctypes.util
 import hashlib
+import os
+import threading
+import weakref
+
+from . import secp256k1
+
+def _load_ssl():
+    """Load libssl and declare the signatures of the functions used here."""
+    import ctypes.util
+    lib = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
+
+    lib.BN_new.restype = ctypes.c_void_p
+    lib.BN_new.argtypes = []
 
-ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
+    lib.BN_bin2bn.restype = ctypes.c_void_p
+    lib.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.BN_new.restype = ctypes.c_void_p
-ssl.BN_new.argtypes = []
+    lib.BN_CTX_free.restype = None
+    lib.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.BN_bin2bn.restype = ctypes.c_void_p
-ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+    lib.BN_CTX_new.restype = ctypes.c_void_p
+    lib.BN_CTX_new.argtypes = []
 
-ssl.BN_CTX_free.restype = None
-ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
+    lib.ECDH_compute_key.restype = ctypes.c_int
+    lib.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.BN_CTX_new.restype = ctypes.c_void_p
-ssl.BN_CTX_new.argtypes = []
+    lib.ECDSA_sign.restype = ctypes.c_int
+    lib.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.ECDH_compute_key.restype = ctypes.c_int
-ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+    lib.ECDSA_verify.restype = ctypes.c_int
+    lib.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.ECDSA_sign.restype = ctypes.c_int
-ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_dup.restype = ctypes.c_void_p
+    lib.EC_KEY_dup.argtypes = [ctypes.c_void_p]
 
-ssl.ECDSA_verify.restype = ctypes.c_int
-ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    lib.EC_KEY_free.restype = None
+    lib.EC_KEY_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_free.restype = None
-ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
+    lib.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
+    lib.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
+    lib.EC_KEY_get0_group.restype = ctypes.c_void_p
+    lib.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
+    lib.EC_KEY_get0_public_key.restype = ctypes.c_void_p
+    lib.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
+    lib.EC_KEY_set_private_key.restype = ctypes.c_int
+    lib.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_set_private_key.restype = ctypes.c_int
-ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_set_conv_form.restype = None
+    lib.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
 
-ssl.EC_KEY_set_conv_form.restype = None
-ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.EC_KEY_set_public_key.restype = ctypes.c_int
+    lib.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_set_public_key.restype = ctypes.c_int
-ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.i2o_ECPublicKey.restype = ctypes.c_void_p
+    lib.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
-ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_POINT_new.restype = ctypes.c_void_p
+    lib.EC_POINT_new.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_new.restype = ctypes.c_void_p
-ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+    lib.EC_POINT_free.restype = None
+    lib.EC_POINT_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_free.restype = None
-ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+    lib.EC_POINT_mul.restype = ctypes.c_int
+    lib.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_POINT_mul.restype = ctypes.c_int
-ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_new_by_curve_name.errcheck = _check_result
+    return lib
+
+class _LazySSL():
+    """Stands in for libssl until it is first used, so that importing this module is cheap."""
+
+    def __getattr__(self, name):
+        global ssl
+        ssl = _load_ssl()
+        return getattr(ssl, name)
+
+ssl = _LazySSL()
 
 # this specifies the curve used with ECDSA.
 NID_secp256k1 = 714 # from openssl/obj_mac.h
@@ -73,6 +101,10 @@ NID_secp256k1 = 714 # from openssl/obj_mac.h
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
+# Signatures that sign_batch() keeps per key, for (hash, low_s) pairs it is
+# asked to sign again
+SIGNATURE_CACHE_SIZE = 10000
+
 # Thx to Sam Devlin for the ctypes magic 64-bit fix.
 def _check_result(val, func, args):
     if val == 0:
@@ -80,14 +112,34 @@ def _check_result(val, func, args):
     else:
         return ctypes.c_void_p (val)
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
-
 class CECKey():
-    """Wrapper around OpenSSL's EC_KEY"""
+    """A secp256k1 key of the selected backend, see get_backend()"""
 
     POINT_CONVERSION_COMPRESSED = 2
     POINT_CONVERSION_UNCOMPRESSED = 4
+    POINT_CONVERSION_HYBRID = 6
+
+    # Bumped whenever the key is set, so that sign_batch() and verify_batch()
+    # don't use copies or signatures of the key's previous value
+    generation = 0
+
+    def __new__(cls):
+        if cls is CECKey:
+            cls = get_backend()
+        return super().__new__(cls)
+
+    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
+        # FIXME: be warned it's not clear what the kdf should be as a default
+        r = self.get_raw_ecdh_key(other_pubkey)
+        return kdf(r)
+
+    def _key_changed(self):
+        self.generation += 1
+        _signature_cache.pop(self, None)
+
+
+class OpenSSLECKey(CECKey):
+    """Wrapper around OpenSSL's EC_KEY"""
 
     def __init__(self):
         self.k = ssl.EC_KEY_new_by_curve_name(NID_secp256k1)
@@ -97,7 +149,18 @@ class CECKey():
             ssl.EC_KEY_free(self.k)
         self.k = None
 
+    def copy(self):
+        """Return a CECKey with its own copy of this key's EC_KEY"""
+        k = ssl.EC_KEY_dup(self.k)
+        if not k:
+            raise ValueError("Could not copy the key.")
+        other = OpenSSLECKey.__new__(OpenSSLECKey)
+        # Like EC_KEY_new_by_curve_name()'s result, see _check_result()
+        other.k = ctypes.c_void_p(k)
+        return other
+
     def set_secretbytes(self, secret):
+        self._key_changed()
         priv_key = ssl.BN_bin2bn(secret, 32, ssl.BN_new())
         group = ssl.EC_KEY_get0_group(self.k)
         pub_key = ssl.EC_POINT_new(group)
@@ -112,10 +175,12 @@ class CECKey():
         return self.k
 
     def set_privkey(self, key):
+        self._key_changed()
         self.mb = ctypes.create_string_buffer(key)
         return ssl.d2i_ECPrivateKey(ctypes.byref(self.k), ctypes.byref(ctypes.pointer(self.mb)), len(key))
 
     def set_pubkey(self, key):
+        self._key_changed()
         self.mb = ctypes.create_string_buffer(key)
         return ssl.o2i_ECPublicKey(ctypes.byref(self.k), ctypes.byref(ctypes.pointer(self.mb)), len(key))
 
@@ -140,11 +205,6 @@ class CECKey():
             raise Exception('CKey.get_ecdh_key(): ECDH_compute_key() failed')
         return ecdh_keybuffer.raw
 
-    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
-        # FIXME: be warned it's not clear what the kdf should be as a default
-        r = self.get_raw_ecdh_key(other_pubkey)
-        return kdf(r)
-
     def sign(self, hash, low_s = True):
         # FIXME: need unit tests for below cases
         if not isinstance(hash, bytes):
@@ -189,6 +249,247 @@ class CECKey():
         ssl.EC_KEY_set_conv_form(self.k, form)
 
 
+# The DER encoding of the secp256k1 OID, 1.3.132.0.10
+SECP256K1_OID = b'\x06\x05\x2b\x81\x04\x00\x0a'
+
+def _der_integer(value):
+    data = value.to_bytes(value.bit_length() // 8 + 1, 'big')
+    return b'\x02' + bytes([len(data)]) + data
+
+def _parse_der_signature(sig):
+    """Return the (r, s) of a strictly DER-encoded signature, or None."""
+    if len(sig) < 8 or sig[0] != 0x30 or sig[1] != len(sig) - 2:
+        return None
+    values = []
+    pos = 2
+    for _ in range(2):
+        if pos + 2 > len(sig) or sig[pos] != 0x02:
+            return None
+        size = sig[pos + 1]
+        data = sig[pos + 2:pos + 2 + size]
+        # Positive and minimally encoded
+        if size == 0 or len(data) != size or data[0] & 0x80 or (size > 1 and data[0] == 0 and not data[1] & 0x80):
+            return None
+        values.append(int.from_bytes(data, 'big'))
+        pos += 2 + size
+    if pos != len(sig):
+        return None
+    return values
+
+class PythonECKey(CECKey):
+    """A secp256k1 key in pure Python, with the interface of OpenSSLECKey
+
+    Signatures are deterministic (RFC 6979)."""
+
+    def __init__(self):
+        self.secret = None
+        self.point = None
+        # OpenSSL's default
+        self.conv_form = self.POINT_CONVERSION_UNCOMPRESSED
+
+    def copy(self):
+        other = PythonECKey()
+        other.secret, other.point, other.conv_form = self.secret, self.point, self.conv_form
+        return other
+
+    def set_secretbytes(self, secret):
+        # Like BN_bin2bn(secret, 32) in OpenSSLECKey, which reads 32 bytes
+        secret = int.from_bytes(secret[:32].ljust(32, b'\x00'), 'big') % secp256k1.N
+        if secret == 0:
+            raise ValueError("Could not derive public key from the supplied secret.")
+        self._key_changed()
+        self.secret = secret
+        self.point = secp256k1.to_affine(secp256k1.generator_multiply(secret))
+
+    def set_privkey(self, key):
+        """Load an SEC1 DER private key, as get_privkey() returns. Returns 0 on failure."""
+        if len(key) < 39 or key[0] != 0x30 or key[2:7] != b'\x02\x01\x01\x04\x20':
+            return 0
+        self.set_secretbytes(key[7:39])
+        return 1
+
+    def set_pubkey(self, key):
+        """Load a compressed, uncompressed or hybrid public key. Returns 0 on failure."""
+        if len(key) == 33 and key[0] in (2, 3):
+            point = secp256k1.lift_x(int.from_bytes(key[1:], 'big'), key[0] & 1)
+            conv_form = self.POINT_CONVERSION_COMPRESSED
+        elif len(key) == 65 and key[0] in (4, 6, 7):
+            point = (int.from_bytes(key[1:33], 'big'), int.from_bytes(key[33:], 'big'))
+            if not secp256k1.is_on_curve(point) or (key[0] != 4 and point[1] & 1 != key[0] & 1):
+                point = None
+            conv_form = self.POINT_CONVERSION_UNCOMPRESSED if key[0] == 4 else self.POINT_CONVERSION_HYBRID
+        else:
+            point = None
+        if point is None:
+            return 0
+        self._key_changed()
+        self.point = point
+        self.conv_form = conv_form
+        return 1
+
+    def get_privkey(self):
+        """The SEC1 DER encoding of the private key, with the curve and the public key."""
+        pubkey = self.get_pubkey()
+        der = b'\x02\x01\x01\x04\x20' + self.secret.to_bytes(32, 'big')
+        der += b'\xa0' + bytes([len(SECP256K1_OID)]) + SECP256K1_OID
+        der += b'\xa1' + bytes([len(pubkey) + 3]) + b'\x03' + bytes([len(pubkey) + 1]) + b'\x00' + pubkey
+        return b'\x30' + bytes([len(der)]) + der
+
+    def get_pubkey(self):
+        if self.point is None:
+            return b''
+        x, y = self.point
+        if self.conv_form == self.POINT_CONVERSION_COMPRESSED:
+            return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+        prefix = 4 if self.conv_form == self.POINT_CONVERSION_UNCOMPRESSED else 6 + (y & 1)
+        return bytes([prefix]) + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+    def get_raw_ecdh_key(self, other_pubkey):
+        if self.secret is None or other_pubkey.point is None:
+            raise Exception('CKey.get_ecdh_key(): ECDH_compute_key() failed')
+        return secp256k1.to_affine(secp256k1.point_multiply(self.secret, other_pubkey.point))[0].to_bytes(32, 'big')
+
+    def sign(self, hash, low_s = True):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+        if self.secret is None:
+            raise ValueError('Cannot sign without a private key')
+        r, s = secp256k1.ecdsa_sign(self.secret, hash)
+        if low_s and s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        body = _der_integer(r) + _der_integer(s)
+        return b'\x30' + bytes([len(body)]) + body
+
+    def verify(self, hash, sig):
+        """Verify a strict DER signature"""
+        rs = _parse_der_signature(sig)
+        if rs is None or self.point is None:
+            return False
+        # Like OpenSSL, use the leftmost 256 bits of longer hashes
+        return secp256k1.ecdsa_verify(self.point, hash[:32], *rs)
+
+    def set_compressed(self, compressed):
+        if compressed:
+            self.conv_form = self.POINT_CONVERSION_COMPRESSED
+        else:
+            self.conv_form = self.POINT_CONVERSION_UNCOMPRESSED
+
+
+ECC_BACKENDS = {
+    "openssl": OpenSSLECKey,
+    "python": PythonECKey,
+}
+
+_backend = None
+
+def set_backend(name):
+    """Make CECKey() create keys of the named backend in ECC_BACKENDS."""
+    global _backend
+    _backend = ECC_BACKENDS[name]
+
+def get_backend():
+    """Return the class of the keys CECKey() creates.
+
+    Unless set_backend() was called, this is OpenSSLECKey if libssl can be
+    loaded and supports secp256k1, and PythonECKey otherwise."""
+    global _backend
+    if _backend is None:
+        try:
+            ssl.EC_KEY_free(ssl.EC_KEY_new_by_curve_name(NID_secp256k1))
+            _backend = OpenSSLECKey
+        except (OSError, AttributeError, ValueError):
+            _backend = PythonECKey
+    return _backend
+
+
+_batch_executor = None
+_batch_executor_workers = 0
+_thread_keys = threading.local()
+# The signatures sign_batch() made, per key
+_signature_cache = weakref.WeakKeyDictionary()
+
+def _thread_key(key):
+    """Return the current thread's copy of key, so that no two threads use an EC_KEY at once.
+
+    The copies live as long as the key does, and are reused for every batch
+    until the key is set to another value."""
+    copies = getattr(_thread_keys, 'copies', None)
+    if copies is None:
+        copies = _thread_keys.copies = weakref.WeakKeyDictionary()
+    generation, copy = copies.get(key, (None, None))
+    if generation != key.generation:
+        copy = key.copy()
+        copies[key] = (key.generation, copy)
+    return copy
+
+def _sign_chunk(chunk):
+    return [_thread_key(key).sign(hash, low_s) for key, hash, low_s in chunk]
+
+def _verify_chunk(chunk):
+    return [_thread_key(key).verify(hash, sig) for key, hash, sig in chunk]
+
+def _run_batch(func, items, max_workers):
+    """Apply func to chunks of items on a pool of threads, and return the concatenated results.
+
+    The OpenSSL calls release the GIL, so the chunks are signed or verified
+    in parallel."""
+    global _batch_executor, _batch_executor_workers
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers <= 1 or len(items) <= 1:
+        return func(items)
+    if _batch_executor_workers < max_workers:
+        from concurrent.futures import ThreadPoolExecutor
+        if _batch_executor is not None:
+            _batch_executor.shutdown(wait=False)
+        _batch_executor = ThreadPoolExecutor(max_workers=max_workers)
+        _batch_executor_workers = max_workers
+    # A few chunks per worker, to balance the load without a future per item
+    num_chunks = min(len(items), 4 * max_workers)
+    chunks = [items[i::num_chunks] for i in range(num_chunks)]
+    results = [None] * len(items)
+    for i, chunk_results in enumerate(_batch_executor.map(func, chunks)):
+        results[i::num_chunks] = chunk_results
+    return results
+
+def sign_batch(items, low_s=True, *, max_workers=None):
+    """Sign a list of (CECKey, hash) pairs. Returns the signatures in the same order.
+
+    The signatures are made on up to max_workers threads (default: one per
+    CPU). A key's signature of a hash is cached, so signing the same hash with
+    the same key again, in this batch or a later one, returns the same
+    signature."""
+    results = [None] * len(items)
+    to_sign = {}
+    for i, (key, hash) in enumerate(items):
+        cache = _signature_cache.get(key)
+        sig = None if cache is None else cache.get((hash, low_s))
+        if sig is not None:
+            results[i] = sig
+        else:
+            to_sign.setdefault((key, hash), []).append(i)
+    if to_sign:
+        pairs = list(to_sign)
+        sigs = _run_batch(_sign_chunk, [(key, hash, low_s) for key, hash in pairs], max_workers)
+        for (key, hash), sig in zip(pairs, sigs):
+            cache = _signature_cache.setdefault(key, {})
+            if len(cache) >= SIGNATURE_CACHE_SIZE:
+                cache.clear()
+            cache[(hash, low_s)] = sig
+            for i in to_sign[(key, hash)]:
+                results[i] = sig
+    return results
+
+def verify_batch(items, *, max_workers=None):
+    """Verify a list of (key, hash, DER signature) triples, where the keys are CECKeys or CPubKeys.
+
+    Returns a list of booleans in the same order. The signatures are verified
+    on up to max_workers threads (default: one per CPU)."""
+    return _run_batch(_verify_chunk, [(getattr(key, '_cec_key', key), hash, sig) for key, hash, sig in items], max_workers)
+
+
 class CPubKey(bytes):
     """An encapsulated public key
 
@@ -17,6 +17,13 @@ ser_*, deser_*: functions that handle serialization/deserialization.
 
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
+
+CTxIn, CTxOut, CTxInWitness and CTransaction memoize their serialization (and
+for CTransaction, the txid and wtxid) in a private _cache slot. Each cache
+entry records the field values it was computed from, with scripts and witness
+stack items copied to bytes, and is only reused while those are unchanged, so
+tests can keep mutating these objects freely, including bytearray scripts in
+place.
 """
 from codecs import encode
 import copy
@@ -27,7 +34,7 @@ import socket
 import struct
 import time
 
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_batch
 from test_framework.util import hex_str_to_bytes, bytes_to_hex_str, assert_equal
 
 MIN_VERSION_SUPPORTED = 60001
@@ -48,11 +55,23 @@ NODE_BLOOM = (1 << 2)
 NODE_WITNESS = (1 << 3)
 NODE_NETWORK_LIMITED = (1 << 10)
 
+UINT256_MASK = (1 << 256) - 1
+
 MSG_TX = 1
 MSG_BLOCK = 2
 MSG_WITNESS_FLAG = 1 << 30
 MSG_TYPE_MASK = 0xffffffff >> 2
 
+# Precompiled struct objects, shared by the serialization helpers below
+_struct_B = struct.Struct("<B")
+_struct_H = struct.Struct("<H")
+_struct_i = struct.Struct("<i")
+_struct_I = struct.Struct("<I")
+_struct_q = struct.Struct("<q")
+_struct_Q = struct.Struct("<Q")
+_struct_outpoint = struct.Struct("<32sI")
+_struct_header = struct.Struct("<i32s32sIII")
+
 # Serialization/deserialization tools
 def sha256(s):
     return hashlib.new('sha256', s).digest()
@@ -86,9 +105,38 @@ def deser_string(f):
     nit = deser_compact_size(f)
     return f.read(nit)
 
+# The deser_*_from functions are the zero-copy counterparts of deser_*: they
+# read from a bytes-like object (usually a memoryview) at the given offset and
+# return a (value, new_offset) tuple instead of consuming a stream.
+def deser_compact_size_from(buf, pos):
+    nit = buf[pos]
+    pos += 1
+    if nit < 253:
+        return nit, pos
+    if nit == 253:
+        return _struct_H.unpack_from(buf, pos)[0], pos + 2
+    if nit == 254:
+        return _struct_I.unpack_from(buf, pos)[0], pos + 4
+    return _struct_Q.unpack_from(buf, pos)[0], pos + 8
+
+def deser_string_from(buf, pos):
+    nit = buf[pos]
+    if nit < 253:
+        pos += 1
+    else:
+        nit, pos = deser_compact_size_from(buf, pos)
+    return bytes(buf[pos:pos + nit]), pos + nit
+
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+# The ser_*_into functions are the single-buffer counterparts of ser_*: they
+# append to the bytearray r instead of returning a new bytes object, so that
+# large structures are serialized in linear time.
+def ser_string_into(r, s):
+    r += ser_compact_size(len(s))
+    r += s
+
 def deser_uint256(f):
     r = 0
     for i in range(8):
@@ -97,12 +145,12 @@ def deser_uint256(f):
     return r
 
 
+def deser_uint256_from(buf, pos):
+    return int.from_bytes(buf[pos:pos + 32], 'little'), pos + 32
+
+
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
@@ -129,17 +177,50 @@ def deser_vector(f, c):
     return r
 
 
+def deser_vector_from(buf, pos, c):
+    nit, pos = deser_compact_size_from(buf, pos)
+    r = []
+    for i in range(nit):
+        t = c()
+        pos = t.deserialize_from(buf, pos)
+        r.append(t)
+    return r, pos
+
+
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
+    r = bytearray()
+    ser_vector_into(r, l, ser_function_name)
+    return bytes(r)
+
+
+# Maps (class, ser_function_name) to whether the class that defines
+# ser_function_name also defines <ser_function_name>_into next to it.
+_ser_into_cache = {}
+
+def _can_ser_into(cls, ser_function_name):
+    key = (cls, ser_function_name)
+    if key not in _ser_into_cache:
+        owner = next((k for k in cls.__mro__ if ser_function_name in k.__dict__), None)
+        _ser_into_cache[key] = owner is not None and ser_function_name + "_into" in owner.__dict__
+    return _ser_into_cache[key]
+
+# Entries that provide a <ser_function_name>_into method write straight into
+# r; all others are serialized on their own and appended. Subclasses that
+# override ser_function_name (eg to produce deliberately broken encodings)
+# without overriding the _into variant take the latter path, so that their
+# override is honoured.
+def ser_vector_into(r, vec, ser_function_name=None):
+    if ser_function_name is None:
+        ser_function_name = "serialize"
+    r += ser_compact_size(len(vec))
+    for i in vec:
+        if _can_ser_into(type(i), ser_function_name):
+            getattr(i, ser_function_name + "_into")(r)
         else:
-            r += i.serialize()
-    return r
+            r += getattr(i, ser_function_name)()
 
 
 def deser_uint256_vector(f):
@@ -151,11 +232,20 @@ def deser_uint256_vector(f):
     return r
 
 
+def deser_uint256_vector_from(buf, pos):
+    nit, pos = deser_compact_size_from(buf, pos)
+    r = []
+    for i in range(nit):
+        t, pos = deser_uint256_from(buf, pos)
+        r.append(t)
+    return r, pos
+
+
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         r += ser_uint256(i)
-    return r
+    return bytes(r)
 
 
 def deser_string_vector(f):
@@ -167,17 +257,39 @@ def deser_string_vector(f):
     return r
 
 
+def deser_string_vector_from(buf, pos):
+    nit, pos = deser_compact_size_from(buf, pos)
+    r = []
+    for i in range(nit):
+        t, pos = deser_string_from(buf, pos)
+        r.append(t)
+    return r, pos
+
+
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    r = bytearray()
+    ser_string_vector_into(r, l)
+    return bytes(r)
+
 
+def ser_string_vector_into(r, vec):
+    r += ser_compact_size(len(vec))
+    for sv in vec:
+        ser_string_into(r, sv)
+
+
+# Deserialize from a bytes-like object, using the zero-copy deserialize_from
+# path when the object supports it
+def FromBytes(obj, data):
+    if hasattr(obj, "deserialize_from"):
+        obj.deserialize_from(data, 0)
+    else:
+        obj.deserialize(BytesIO(data))
+    return obj
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
-    return obj
+    return FromBytes(obj, hex_str_to_bytes(hex_string))
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
 def ToHex(obj):
@@ -239,6 +351,11 @@ class CInv:
         self.type = struct.unpack("<i", f.read(4))[0]
         self.hash = deser_uint256(f)
 
+    def deserialize_from(self, buf, pos):
+        self.type = _struct_i.unpack_from(buf, pos)[0]
+        self.hash, pos = deser_uint256_from(buf, pos + 4)
+        return pos
+
     def serialize(self):
         r = b""
         r += struct.pack("<i", self.type)
@@ -283,18 +400,26 @@ class COutPoint:
         self.hash = deser_uint256(f)
         self.n = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos):
+        self.hash, pos = deser_uint256_from(buf, pos)
+        self.n = _struct_I.unpack_from(buf, pos)[0]
+        return pos + 4
+
     def serialize(self):
-        r = b""
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
         r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        r += _struct_I.pack(self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
 class CTxIn:
-    __slots__ = ("nSequence", "prevout", "scriptSig")
+    __slots__ = ("_cache", "nSequence", "prevout", "scriptSig")
 
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
@@ -303,6 +428,7 @@ class CTxIn:
             self.prevout = outpoint
         self.scriptSig = scriptSig
         self.nSequence = nSequence
+        self._cache = None
 
     def deserialize(self, f):
         self.prevout = COutPoint()
@@ -310,12 +436,27 @@ class CTxIn:
         self.scriptSig = deser_string(f)
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos):
+        prevout_hash, prevout_n = _struct_outpoint.unpack_from(buf, pos)
+        self.prevout = COutPoint(int.from_bytes(prevout_hash, 'little'), prevout_n)
+        self.scriptSig, pos = deser_string_from(buf, pos + 36)
+        self.nSequence = _struct_I.unpack_from(buf, pos)[0]
+        return pos + 4
+
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
+        key = (self.prevout.hash, self.prevout.n, bytes(self.scriptSig), self.nSequence)
+        if self._cache is None or self._cache[0] != key:
+            c = bytearray()
+            self.prevout.serialize_into(c)
+            ser_string_into(c, self.scriptSig)
+            c += _struct_I.pack(self.nSequence)
+            self._cache = (key, bytes(c))
+        r += self._cache[1]
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -324,21 +465,34 @@ class CTxIn:
 
 
 class CTxOut:
-    __slots__ = ("nValue", "scriptPubKey")
+    __slots__ = ("_cache", "nValue", "scriptPubKey")
 
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
+        self._cache = None
 
     def deserialize(self, f):
         self.nValue = struct.unpack("<q", f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
+    def deserialize_from(self, buf, pos):
+        self.nValue = _struct_q.unpack_from(buf, pos)[0]
+        self.scriptPubKey, pos = deser_string_from(buf, pos + 8)
+        return pos
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
+        key = (self.nValue, bytes(self.scriptPubKey))
+        if self._cache is None or self._cache[0] != key:
+            c = bytearray(_struct_q.pack(self.nValue))
+            ser_string_into(c, self.scriptPubKey)
+            self._cache = (key, bytes(c))
+        r += self._cache[1]
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -364,17 +518,31 @@ class CScriptWitness:
 
 
 class CTxInWitness:
-    __slots__ = ("scriptWitness",)
+    __slots__ = ("_cache", "scriptWitness",)
 
     def __init__(self):
         self.scriptWitness = CScriptWitness()
+        self._cache = None
 
     def deserialize(self, f):
         self.scriptWitness.stack = deser_string_vector(f)
 
+    def deserialize_from(self, buf, pos):
+        self.scriptWitness.stack, pos = deser_string_vector_from(buf, pos)
+        return pos
+
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
+    # The cache key is a copy of the stack, since tests modify it in place.
+    def serialize_into(self, r):
+        stack = self.scriptWitness.stack
+        if self._cache is None or self._cache[0] != stack:
+            c = bytearray()
+            ser_string_vector_into(c, stack)
+            self._cache = ([bytes(item) for item in stack], bytes(c))
+        r += self._cache[1]
+
     def __repr__(self):
         return repr(self.scriptWitness)
 
@@ -392,14 +560,22 @@ class CTxWitness:
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        for i in range(len(self.vtxinwit)):
+            pos = self.vtxinwit[i].deserialize_from(buf, pos)
+        return pos
+
     def serialize(self):
-        r = b""
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+            x.serialize_into(r)
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -413,10 +589,11 @@ class CTxWitness:
 
 
 class CTransaction:
-    __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit")
+    __slots__ = ("_cache", "hash", "nLockTime", "nVersion", "sha256", "vin",
+                 "vout", "wit")
 
     def __init__(self, tx=None):
+        self._cache = {}
         if tx is None:
             self.nVersion = 1
             self.vin = []
@@ -456,58 +633,99 @@ class CTransaction:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, pos):
+        self.nVersion = _struct_i.unpack_from(buf, pos)[0]
+        self.vin, pos = deser_vector_from(buf, pos + 4, CTxIn)
+        flags = 0
+        if len(self.vin) == 0:
+            flags = buf[pos]
+            pos += 1
+            if (flags != 0):
+                self.vin, pos = deser_vector_from(buf, pos, CTxIn)
+                self.vout, pos = deser_vector_from(buf, pos, CTxOut)
+        else:
+            self.vout, pos = deser_vector_from(buf, pos, CTxOut)
+        if flags != 0:
+            self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
+            pos = self.wit.deserialize_from(buf, pos)
+        else:
+            self.wit = CTxWitness()
+        self.nLockTime = _struct_I.unpack_from(buf, pos)[0]
+        self.sha256 = None
+        self.hash = None
+        return pos + 4
+
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        r = bytearray()
+        self.serialize_without_witness_into(r)
+        return bytes(r)
+
+    def serialize_without_witness_into(self, r):
+        r += _struct_i.pack(self.nVersion)
+        ser_vector_into(r, self.vin)
+        ser_vector_into(r, self.vout)
+        r += _struct_I.pack(self.nLockTime)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        r = bytearray()
+        self.serialize_with_witness_into(r)
+        return bytes(r)
+
+    def serialize_with_witness_into(self, r):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r += _struct_i.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector_into(r, dummy)
+            r += _struct_B.pack(flags)
+        ser_vector_into(r, self.vin)
+        ser_vector_into(r, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            self.wit.serialize_into(r)
+        r += _struct_I.pack(self.nLockTime)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
     def serialize(self):
         return self.serialize_with_witness()
 
+    def serialize_into(self, r):
+        self.serialize_with_witness_into(r)
+
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
         self.sha256 = None
         self.calc_sha256()
         return self.hash
 
+    # Return the hash of the given serialization, reusing the hash memoized
+    # under name if it was computed from the same bytes.
+    def _memoized_hash(self, name, serialized):
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != serialized:
+            cached = self._cache[name] = (serialized, uint256_from_str(hash256(serialized)))
+        return cached[1]
+
     # We will only cache the serialization without witness in
     # self.sha256 and self.hash -- those are expected to be the txid.
+    # The txid and wtxid themselves are memoized, so that rehashing an
+    # unchanged transaction only costs a (mostly cached) serialization.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            return self._memoized_hash("wtxid", self.serialize_with_witness())
 
+        txid = self._memoized_hash("txid", self.serialize_without_witness())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = txid
+        self.hash = "%064x" % txid
 
     def is_valid(self):
         self.calc_sha256()
@@ -559,25 +777,26 @@ class CBlockHeader:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, pos):
+        (self.nVersion, prev_block, merkle_root, self.nTime, self.nBits,
+         self.nNonce) = _struct_header.unpack_from(buf, pos)
+        self.hashPrevBlock = int.from_bytes(prev_block, 'little')
+        self.hashMerkleRoot = int.from_bytes(merkle_root, 'little')
+        self.sha256 = None
+        self.hash = None
+        return pos + _struct_header.size
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        return _struct_header.pack(self.nVersion, ser_uint256(self.hashPrevBlock),
+                                   ser_uint256(self.hashMerkleRoot), self.nTime,
+                                   self.nBits, self.nNonce)
+
+    def serialize_header_into(self, r):
+        r += CBlockHeader.serialize(self)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
+            r = CBlockHeader.serialize(self)
             self.sha256 = uint256_from_str(hash256(r))
             self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
 
@@ -594,25 +813,179 @@ class CBlockHeader:
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
+# Proof-of-work nonce search for CBlock.solve(). The first 64 bytes of a block
+# header don't depend on the nonce, so each candidate is hashed from a copy of
+# the SHA256 midstate over them. Targets that take fewer than
+# SOLVE_PARALLEL_MIN_WORK hashes on average (eg regtest's) are searched
+# serially; harder ones are split into SOLVE_CHUNK_SIZE nonce ranges that are
+# searched by a process pool.
+SOLVE_PARALLEL_MIN_WORK = 1 << 18
+SOLVE_CHUNK_SIZE = 1 << 16
+
+def _search_nonces(args):
+    """Return the first nonce in [start, stop) whose header hash is <= target, or None."""
+    header_prefix, target, start, stop = args
+    midstate = hashlib.sha256(header_prefix[:64])
+    tail = header_prefix[64:]
+    pack_nonce = _struct_I.pack
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(tail + pack_nonce(nonce))
+        if int.from_bytes(hashlib.sha256(h.digest()).digest(), 'little') <= target:
+            return nonce
+    return None
+
+def solve_nonce(header_prefix, target, start_nonce=0, processes=None):
+    """Return the lowest nonce >= start_nonce that makes the 76-byte header_prefix
+    meet target, or None if there is none.
+
+    processes is the size of the process pool to use for hard targets
+    (default: one per CPU). With processes=1 the search is always serial."""
+    import multiprocessing
+    assert_equal(len(header_prefix), BLOCK_HEADER_SIZE - 4)
+    stop = 1 << 32
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    expected_work = (1 << 256) // (target + 1)
+    if processes == 1 or expected_work < SOLVE_PARALLEL_MIN_WORK:
+        return _search_nonces((header_prefix, target, start_nonce, stop))
+    chunks = ((header_prefix, target, start, min(start + SOLVE_CHUNK_SIZE, stop))
+              for start in range(start_nonce, stop, SOLVE_CHUNK_SIZE))
+    with multiprocessing.Pool(processes) as pool:
+        # imap returns the chunks' results in order, so the first hit is
+        # also the lowest valid nonce, as with the serial search.
+        for nonce in pool.imap(_search_nonces, chunks):
+            if nonce is not None:
+                return nonce
+    return None
+
+
+class MerkleTree:
+    """A merkle tree over a list of 32-byte hashes, updated incrementally.
+
+    levels[0] holds the leaves and levels[-1] the root. As in bvaultd, a
+    level with an odd number of nodes pairs its last node with itself.
+    append(), replace(), pop() and update() rehash only the paths from the
+    changed leaves to the root."""
+    __slots__ = ("levels",)
+
+    def __init__(self, hashes=None):
+        self.levels = [[]]
+        if hashes:
+            self.update(hashes)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        """Return the merkle root, serialized as 32 bytes."""
+        if not self.levels[0]:
+            raise IndexError("merkle root of an empty tree")
+        return self.levels[-1][0]
+
+    def append(self, h):
+        self.levels[0].append(h)
+        self._rehash_paths([len(self.levels[0]) - 1])
+
+    def replace(self, index, h):
+        self.levels[0][index] = h
+        self._rehash_paths([index])
+
+    def pop(self):
+        h = self.levels[0].pop()
+        self._rehash_paths([len(self.levels[0]) - 1] if self.levels[0] else [])
+        return h
+
+    def update(self, hashes):
+        """Make the leaves equal to hashes, rehashing only what changed."""
+        leaves = self.levels[0]
+        common = min(len(leaves), len(hashes))
+        changed = [i for i in range(common) if leaves[i] != hashes[i]]
+        changed.extend(range(common, len(hashes)))
+        if 0 < len(hashes) < len(leaves):
+            # the new last leaf may have lost its sibling
+            changed.append(len(hashes) - 1)
+        self.levels[0] = list(hashes)
+        self._rehash_paths(changed)
+
+    def _rehash_paths(self, indexes):
+        """Resize the upper levels to fit the leaves, and rehash the ancestors of the given leaves."""
+        level_len = len(self.levels[0])
+        height = 0
+        indexes = set(indexes)
+        while level_len > 1:
+            level = self.levels[height]
+            level_len = (level_len + 1) // 2
+            if len(self.levels) == height + 1:
+                self.levels.append([])
+            parent = self.levels[height + 1]
+            del parent[level_len:]
+            parent.extend([None] * (level_len - len(parent)))
+            indexes = {i >> 1 for i in indexes}
+            for i in indexes:
+                parent[i] = hash256(level[2 * i] + level[min(2 * i + 1, len(level) - 1)])
+            height += 1
+        del self.levels[height + 1:]
+
+    def branch(self, index):
+        """Return the merkle branch of a leaf: its sibling hashes from the bottom up."""
+        branch = []
+        for level in self.levels[:-1]:
+            branch.append(level[min(index ^ 1, len(level) - 1)])
+            index >>= 1
+        return branch
+
+    def partial_merkle_tree(self, matches):
+        """Build a CPartialMerkleTree proving the leaves for which matches[i] is true.
+
+        This walks the tree like CPartialMerkleTree::TraverseAndBuild in bvaultd."""
+        assert_equal(len(matches), len(self))
+        pmt = CPartialMerkleTree()
+        pmt.nTransactions = len(self)
+
+        def traverse(height, pos):
+            # whether this node is the parent of at least one matched leaf
+            parent_of_match = any(matches[pos << height:(pos + 1) << height])
+            pmt.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                pmt.vHash.append(uint256_from_str(self.levels[height][pos]))
+            else:
+                traverse(height - 1, pos * 2)
+                if pos * 2 + 1 < len(self.levels[height - 1]):
+                    traverse(height - 1, pos * 2 + 1)
+
+        traverse(len(self.levels) - 1, 0)
+        return pmt
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("_merkle_trees", "vtx")
 
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        self._merkle_trees = {}
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
+    def deserialize_from(self, buf, pos):
+        pos = super(CBlock, self).deserialize_from(buf, pos)
+        self.vtx, pos = deser_vector_from(buf, pos, CTransaction)
+        return pos
+
     def serialize(self, with_witness=False):
-        r = b""
-        r += super(CBlock, self).serialize()
+        r = bytearray()
+        self.serialize_into(r, with_witness)
+        return bytes(r)
+
+    def serialize_into(self, r, with_witness=False):
+        self.serialize_header_into(r)
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(r, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            ser_vector_into(r, self.vtx, "serialize_without_witness")
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -625,23 +998,54 @@ class CBlock(CBlockHeader):
             hashes = newhashes
         return uint256_from_str(hashes[0])
 
+    # Return the block's merkle tree, brought up to date with vtx. The trees
+    # are kept between calls, with the txids or wtxids their leaves were
+    # computed from, so that only the leaves of transactions that were added,
+    # removed or changed since the last call are replaced, and only their
+    # paths rehashed.
+    #
+    # A txid leaf is replaced if the transaction's sha256 changed, so as
+    # everywhere else a transaction changed in place must be rehash()ed. The
+    # wtxids are taken from calc_sha256(True) every time, which only rehashes
+    # a transaction whose serialization changed, so changes in place are
+    # always picked up.
+    def get_merkle_tree(self, with_witness=False):
+        tree, keys = self._merkle_trees.setdefault(with_witness, (MerkleTree(), []))
+        if with_witness:
+            # For witness root purposes, the hash of the
+            # coinbase, with witness, is defined to be 0...0
+            new_keys = [0] + [tx.calc_sha256(True) for tx in self.vtx[1:]]
+            new_keys = new_keys[:len(self.vtx)]
+        else:
+            for tx in self.vtx:
+                if tx.sha256 is None:
+                    tx.calc_sha256()
+            new_keys = [tx.sha256 for tx in self.vtx]
+        leaves = tree.levels[0][:len(new_keys)]
+        leaves.extend([None] * (len(new_keys) - len(leaves)))
+        for i in range(len(new_keys)):
+            if i >= len(keys) or keys[i] != new_keys[i]:
+                leaves[i] = ser_uint256(new_keys[i])
+        tree.update(leaves)
+        keys[:] = new_keys
+        return tree
+
+    # Add, replace or remove a transaction. The merkle trees notice changes to
+    # vtx however they are made, so these are only shorthands.
+    def append_tx(self, tx):
+        self.vtx.append(tx)
+
+    def replace_tx(self, index, tx):
+        self.vtx[index] = tx
+
+    def pop_tx(self, index=-1):
+        return self.vtx.pop(index)
+
     def calc_merkle_root(self):
-        hashes = []
-        for tx in self.vtx:
-            tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        return uint256_from_str(self.get_merkle_tree().root())
 
     def calc_witness_merkle_root(self):
-        # For witness root purposes, the hash of the
-        # coinbase, with witness, is defined to be 0...0
-        hashes = [ser_uint256(0)]
-
-        for tx in self.vtx[1:]:
-            # Calculate the hashes with witness data
-            hashes.append(ser_uint256(tx.calc_sha256(True)))
-
-        return self.get_merkle_root(hashes)
+        return uint256_from_str(self.get_merkle_tree(with_witness=True).root())
 
     def is_valid(self):
         self.calc_sha256()
@@ -655,11 +1059,17 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    # Increase nNonce until the block hash meets nBits. See solve_nonce() for
+    # the meaning of processes.
+    def solve(self, processes=None):
         self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.sha256 > target:
-            self.nNonce += 1
+        if self.sha256 > target:
+            header_prefix = CBlockHeader.serialize(self)[:BLOCK_HEADER_SIZE - 4]
+            nonce = solve_nonce(header_prefix, target, self.nNonce + 1, processes)
+            if nonce is None:
+                raise RuntimeError("no nonce above %d solves block %s" % (self.nNonce, self.hash))
+            self.nNonce = nonce
             self.rehash()
 
     def __repr__(self):
@@ -680,6 +1090,11 @@ class PrefilledTransaction:
         self.tx = CTransaction()
         self.tx.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        self.index, pos = deser_compact_size_from(buf, pos)
+        self.tx = CTransaction()
+        return self.tx.deserialize_from(buf, pos)
+
     def serialize(self, with_witness=True):
         r = b""
         r += ser_compact_size(self.index)
@@ -755,6 +1170,11 @@ def calculate_shortid(k0, k1, tx_hash):
     expected_shortid &= 0x0000ffffffffffff
     return expected_shortid
 
+# Calculate the shortids for many transaction hashes at once, see
+# siphash256_batch()
+def calculate_shortids(k0, k1, tx_hashes):
+    return [h & 0x0000ffffffffffff for h in siphash256_batch(k0, k1, tx_hashes)]
+
 
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
@@ -807,15 +1227,53 @@ class HeaderAndShortIDs:
         self.header = CBlockHeader(block)
         self.nonce = nonce
         self.prefilled_txn = [ PrefilledTransaction(i, block.vtx[i]) for i in prefill_list ]
-        self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
+
+    def get_shortid_map(self, txs, use_witness=None):
+        """Map the shortids of txs under this block's siphash keys to the transactions.
+
+        This is the lookup a peer does against its mempool to reconstruct the
+        block. Shortids that more than one of txs map to are mapped to None,
+        as those transactions must be requested rather than guessed.
+        use_witness defaults to that of initialize_from_block()."""
+        if use_witness is None:
+            use_witness = self.use_witness
+        txs = list(txs)
+        tx_hashes = []
+        for tx in txs:
+            if use_witness:
+                tx_hashes.append(tx.calc_sha256(with_witness=True))
+            else:
+                tx.calc_sha256()
+                tx_hashes.append(tx.sha256)
+        return self.get_shortid_map_from_hashes(tx_hashes, txs)
+
+    def get_shortid_map_from_hashes(self, tx_hashes, txs):
+        """Like get_shortid_map(), for transactions whose hashes are known.
+
+        tx_hashes are the wtxids of txs if the shortids use wtxids, and their
+        txids otherwise. Only the siphash depends on the block, so a peer can
+        hash its mempool once for all the blocks it reconstructs."""
+        [k0, k1] = self.get_siphash_keys()
+        shortid_map = {}
+        first_hashes = {}
+        for shortid, tx_hash, tx in zip(calculate_shortids(k0, k1, tx_hashes), tx_hashes, txs):
+            if shortid not in first_hashes:
+                first_hashes[shortid] = tx_hash
+                shortid_map[shortid] = tx
+            elif first_hashes[shortid] != tx_hash:
+                shortid_map[shortid] = None
+        return shortid_map
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
@@ -873,6 +1331,11 @@ class BlockTransactions:
         self.blockhash = deser_uint256(f)
         self.transactions = deser_vector(f, CTransaction)
 
+    def deserialize_from(self, buf, pos):
+        self.blockhash, pos = deser_uint256_from(buf, pos)
+        self.transactions, pos = deser_vector_from(buf, pos, CTransaction)
+        return pos
+
     def serialize(self, with_witness=True):
         r = b""
         r += ser_uint256(self.blockhash)
@@ -1044,6 +1507,10 @@ class msg_inv:
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def deserialize_from(self, buf, pos):
+        self.inv, pos = deser_vector_from(buf, pos, CInv)
+        return pos
+
     def serialize(self):
         return ser_vector(self.inv)
 
@@ -1061,6 +1528,10 @@ class msg_getdata:
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def deserialize_from(self, buf, pos):
+        self.inv, pos = deser_vector_from(buf, pos, CInv)
+        return pos
+
     def serialize(self):
         return ser_vector(self.inv)
 
@@ -1096,12 +1567,18 @@ class msg_tx:
     __slots__ = ("tx",)
     command = b"tx"
 
-    def __init__(self, tx=CTransaction()):
-        self.tx = tx
+    def __init__(self, tx=None):
+        if tx is None:
+            self.tx = CTransaction()
+        else:
+            self.tx = tx
 
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        return self.tx.deserialize_from(buf, pos)
+
     def serialize(self):
         return self.tx.serialize_without_witness()
 
@@ -1129,6 +1606,9 @@ class msg_block:
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        return self.block.deserialize_from(buf, pos)
+
     def serialize(self):
         return self.block.serialize(with_witness=False)
 
@@ -1308,6 +1788,12 @@ class msg_headers:
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def deserialize_from(self, buf, pos):
+        blocks, pos = deser_vector_from(buf, pos, CBlock)
+        for x in blocks:
+            self.headers.append(CBlockHeader(x))
+        return pos
+
     def serialize(self):
         blocks = [CBlock(x) for x in self.headers]
         return ser_vector(blocks)
@@ -1440,6 +1926,9 @@ class msg_blocktxn:
     def deserialize(self, f):
         self.block_transactions.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        return self.block_transactions.deserialize_from(buf, pos)
+
     def serialize(self):
         r = b""
         r += self.block_transactions.serialize(with_witness=False)
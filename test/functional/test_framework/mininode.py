@@ -12,17 +12,24 @@ found in the mini-node branch of http://github.com/jgarzik/pynode.
 P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
 P2PDataStore: A p2p interface class that keeps a store of transactions and blocks
-              and can respond correctly to getdata and getheaders messages"""
+              and can respond correctly to getdata and getheaders messages
+P2PCompactBlockReconstructor: A mixin for p2p interface classes that reconstructs
+              the compact blocks it receives from a pool of transactions"""
 import asyncio
-from collections import defaultdict
-from io import BytesIO
+from collections import defaultdict, namedtuple
 import logging
 import struct
 import sys
 import threading
+import time
 
 from test_framework.messages import (
+    BlockTransactionsRequest,
+    CBlock,
     CBlockHeader,
+    CInv,
+    FromBytes,
+    HeaderAndShortIDs,
     MIN_VERSION_SUPPORTED,
     msg_addr,
     msg_block,
@@ -49,6 +56,7 @@ from test_framework.messages import (
     MSG_TYPE_MASK,
     msg_verack,
     msg_version,
+    MSG_WITNESS_FLAG,
     NODE_NETWORK,
     NODE_WITNESS,
     sha256,
@@ -82,6 +90,9 @@ MESSAGEMAP = {
     b"version": msg_version,
 }
 
+# Size of the P2P message header: magic, command, payload length and checksum
+MSG_HEADER_SIZE = 4 + 12 + 4 + 4
+
 MAGIC_BYTES = {
     "mainnet": b"\xf9\xbe\xb4\xd9",   # mainnet
     "testnet3": b"\x0b\x11\x09\x07",  # testnet3
@@ -99,6 +110,12 @@ class P2PConnection(asyncio.Protocol):
     - deserializing and serializing the P2P message header
     - logging messages as they are sent and received
 
+    Received bytes are appended to the recvbuf bytearray and parsed in place
+    from recvbuf_offset, through a memoryview. The consumed prefix is only
+    dropped once it makes up at least half of the buffer, so a stream of
+    messages is parsed in linear time. bytes_received, bytes_buffered and
+    max_bytes_buffered report on the receive buffer.
+
     This class contains no logic for handing the P2P message payloads. It must be
     sub-classed and the on_message() callback overridden."""
 
@@ -117,11 +134,15 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvbuf_offset = 0
+        self.bytes_received = 0
+        self.max_bytes_buffered = 0
         self.magic_bytes = MAGIC_BYTES[net]
         logger.debug('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
 
         loop = NetworkThread.network_event_loop
+        assert loop, "The network thread only runs in tests that import test_framework.mininode at module level"
         conn_gen_unsafe = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
         conn_gen = lambda: loop.call_soon_threadsafe(loop.create_task, conn_gen_unsafe)
         return conn_gen
@@ -137,6 +158,8 @@ class P2PConnection(asyncio.Protocol):
         assert not self._transport
         logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = transport
+        with mininode_lock:
+            mininode_lock.notify_all()
         if self.on_connection_send_msg:
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
@@ -149,15 +172,25 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvbuf_offset = 0
         self.on_close()
+        with mininode_lock:
+            mininode_lock.notify_all()
 
     # Socket read methods
 
+    @property
+    def bytes_buffered(self):
+        """Number of received bytes that have not been parsed into messages yet."""
+        return len(self.recvbuf) - self.recvbuf_offset
+
     def data_received(self, t):
         """asyncio callback when data is read from the socket."""
         if len(t) > 0:
             self.recvbuf += t
+            self.bytes_received += len(t)
+            self.max_bytes_buffered = max(self.max_bytes_buffered, self.bytes_buffered)
             self._on_data()
 
     def _on_data(self):
@@ -167,34 +200,43 @@ class P2PConnection(asyncio.Protocol):
         parses and verifies the P2P header, then passes the P2P payload to
         the on_message callback for processing."""
         try:
-            while True:
-                if len(self.recvbuf) < 4:
-                    return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[command]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+            # All views into recvbuf must be released before it is resized.
+            with memoryview(self.recvbuf) as buf:
+                while True:
+                    pos = self.recvbuf_offset
+                    if len(buf) - pos < 4:
+                        break
+                    if buf[pos:pos+4] != self.magic_bytes:
+                        raise ValueError("got garbage %s" % repr(bytes(buf[pos:])))
+                    if len(buf) - pos < MSG_HEADER_SIZE:
+                        break
+                    command = bytes(buf[pos+4:pos+4+12]).split(b"\x00", 1)[0]
+                    msglen = struct.unpack_from("<i", buf, pos+4+12)[0]
+                    checksum = bytes(buf[pos+4+12+4:pos+MSG_HEADER_SIZE])
+                    if len(buf) - pos < MSG_HEADER_SIZE + msglen:
+                        break
+                    with buf[pos+MSG_HEADER_SIZE:pos+MSG_HEADER_SIZE+msglen] as msg:
+                        th = sha256(msg)
+                        h = sha256(th)
+                        if checksum != h[:4]:
+                            raise ValueError("got bad checksum " + repr(bytes(buf[pos:])))
+                        self.recvbuf_offset = pos + MSG_HEADER_SIZE + msglen
+                        if command not in MESSAGEMAP:
+                            raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(bytes(msg))))
+                        t = FromBytes(MESSAGEMAP[command](), msg)
+                    self._log_message("receive", t)
+                    self.on_message(t)
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
+        finally:
+            self._compact_recvbuf()
+
+    def _compact_recvbuf(self):
+        """Drop the parsed prefix of recvbuf once it makes up at least half of it."""
+        if self.recvbuf_offset and self.recvbuf_offset * 2 >= len(self.recvbuf):
+            del self.recvbuf[:self.recvbuf_offset]
+            self.recvbuf_offset = 0
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
@@ -308,6 +350,9 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                # Wake up threads waiting for this message in wait_until
+                mininode_lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -429,7 +474,12 @@ class P2PInterface(P2PConnection):
 # P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-mininode_lock = threading.RLock()
+#
+# It is a condition variable over a re-entrant lock: the network thread notifies
+# it after delivering each message and on every connect and disconnect, so that
+# wait_until(..., lock=mininode_lock) wakes up as soon as its predicate may
+# have become true.
+mininode_lock = threading.Condition(threading.RLock())
 
 
 class NetworkThread(threading.Thread):
@@ -579,3 +629,161 @@ class P2PDataStore(P2PInterface):
                 # Check that none of the txs are now in the mempool
                 for tx in txs:
                     assert tx.hash not in raw_mempool, "{} tx found in mempool".format(tx.hash)
+
+
+# The outcome of one compact block, see P2PCompactBlockReconstructor.
+# num_missing transactions were not in the pool and had to be requested,
+# success is False if the block then had to be requested in full, and latency
+# is the time in seconds from the cmpctblock to the complete block.
+CompactBlockReconstruction = namedtuple("CompactBlockReconstruction", ["blockhash", "num_txs", "num_prefilled", "num_missing", "latency", "success"])
+
+class P2PCompactBlockReconstructor:
+    """A mixin that reconstructs the compact blocks a P2PInterface receives.
+
+    List it before P2PInterface in the bases of a test's p2p class. It keeps
+    a pool of transactions, by txid, which transactions received in tx
+    messages are added to. The shortids of each cmpctblock are resolved
+    against the pool, and a getblocktxn is sent for just the indexes of the
+    transactions that are missing from it. Once the blocktxn arrives the block
+    is complete. If it doesn't match its merkle root, e.g. after a shortid
+    collision, the full block is requested with getdata, as in BIP 152.
+
+    Complete blocks, reconstructed or received in full, are kept in
+    reconstructed_blocks, by block hash, and their transactions are removed
+    from the pool. Each compact block's outcome is appended to
+    reconstructions, see get_reconstruction_stats(). Set compact_use_witness
+    to False for version 1 compact blocks, whose shortids are computed from
+    txids rather than wtxids."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compact_use_witness = True
+        self.tx_pool = {}
+        # The wtxids of the transactions in tx_pool, by txid. They are
+        # computed once, so that a cmpctblock only costs the siphashes.
+        self.tx_pool_wtxids = {}
+        # Blocks waiting for a blocktxn. key is block hash, value is a
+        # (start time, header, txs, missing indexes, number of prefilled txs) tuple
+        self.pending_compact_blocks = {}
+        # Blocks requested in full after they failed to reconstruct. key is
+        # block hash, value is a (start time, number of prefilled txs, number
+        # of missing txs) tuple
+        self.pending_full_blocks = {}
+        self.reconstructed_blocks = {}
+        self.reconstructions = []
+
+    def add_to_tx_pool(self, txs):
+        with mininode_lock:
+            for tx in txs:
+                tx.calc_sha256()
+                self.tx_pool[tx.sha256] = tx
+                self.tx_pool_wtxids[tx.sha256] = tx.calc_sha256(with_witness=True)
+
+    def remove_from_tx_pool(self, txids):
+        with mininode_lock:
+            for txid in txids:
+                self.tx_pool.pop(txid, None)
+                self.tx_pool_wtxids.pop(txid, None)
+
+    def on_tx(self, message):
+        super().on_tx(message)
+        self.add_to_tx_pool([message.tx])
+
+    def on_cmpctblock(self, message):
+        super().on_cmpctblock(message)
+        start = time.perf_counter()
+        compact = HeaderAndShortIDs(message.header_and_shortids)
+        compact.use_witness = self.compact_use_witness
+        header = compact.header
+        header.calc_sha256()
+        if header.sha256 in self.reconstructed_blocks or header.sha256 in self.pending_compact_blocks or header.sha256 in self.pending_full_blocks:
+            return
+        txs = [None] * (len(compact.prefilled_txn) + len(compact.shortids))
+        for prefilled in compact.prefilled_txn:
+            txs[prefilled.index] = prefilled.tx
+        txids = list(self.tx_pool)
+        tx_hashes = [self.tx_pool_wtxids[txid] for txid in txids] if self.compact_use_witness else txids
+        shortid_map = compact.get_shortid_map_from_hashes(tx_hashes, [self.tx_pool[txid] for txid in txids])
+        shortids = iter(compact.shortids)
+        missing = []
+        for i in range(len(txs)):
+            if txs[i] is None:
+                txs[i] = shortid_map.get(next(shortids))
+                if txs[i] is None:
+                    missing.append(i)
+        if not missing:
+            self._complete_compact_block(start, header, txs, 0, len(compact.prefilled_txn))
+            return
+        self.pending_compact_blocks[header.sha256] = (start, header, txs, missing, len(compact.prefilled_txn))
+        msg = msg_getblocktxn()
+        msg.block_txn_request = BlockTransactionsRequest(header.sha256)
+        msg.block_txn_request.from_absolute(missing)
+        self.send_message(msg)
+
+    def on_blocktxn(self, message):
+        super().on_blocktxn(message)
+        block_transactions = message.block_transactions
+        pending = self.pending_compact_blocks.pop(block_transactions.blockhash, None)
+        if pending is None:
+            return
+        start, header, txs, missing, num_prefilled = pending
+        if len(block_transactions.transactions) == len(missing):
+            for i, tx in zip(missing, block_transactions.transactions):
+                txs[i] = tx
+        self._complete_compact_block(start, header, txs, len(missing), num_prefilled)
+
+    def on_block(self, message):
+        super().on_block(message)
+        block = message.block
+        block.calc_sha256()
+        pending = self.pending_full_blocks.pop(block.sha256, None)
+        if pending is None:
+            return
+        start, num_prefilled, num_missing = pending
+        for tx in block.vtx:
+            tx.calc_sha256()
+        self._finish_block(block, start, num_prefilled, num_missing, False)
+
+    def _complete_compact_block(self, start, header, txs, num_missing, num_prefilled):
+        block = CBlock(header)
+        block.vtx = txs
+        if all(tx is not None for tx in txs) and block.calc_merkle_root() == block.hashMerkleRoot:
+            self._finish_block(block, start, num_prefilled, num_missing, True)
+            return
+        logger.debug('compact block {} did not reconstruct, requesting the full block'.format(header.hash))
+        self.pending_full_blocks[header.sha256] = (start, num_prefilled, num_missing)
+        inv_type = MSG_BLOCK | MSG_WITNESS_FLAG if self.compact_use_witness else MSG_BLOCK
+        self.send_message(msg_getdata([CInv(inv_type, header.sha256)]))
+
+    def _finish_block(self, block, start, num_prefilled, num_missing, success):
+        self.reconstructed_blocks[block.sha256] = block
+        self.remove_from_tx_pool(tx.sha256 for tx in block.vtx)
+        self.reconstructions.append(CompactBlockReconstruction(block.sha256, len(block.vtx), num_prefilled, num_missing, time.perf_counter() - start, success))
+
+    def wait_for_reconstruction(self, blockhash, timeout=60):
+        """Wait until the block with this hash is complete, and return it.
+
+        That is the block received in full if it failed to reconstruct."""
+        wait_until(lambda: blockhash in self.reconstructed_blocks, timeout=timeout, lock=mininode_lock)
+        with mininode_lock:
+            return self.reconstructed_blocks[blockhash]
+
+    def get_reconstruction_stats(self):
+        """Summarize reconstructions.
+
+        Returns a dict with the number of complete compact blocks, how many of
+        them needed a getblocktxn and how many had to be received in full, the
+        fraction of the transactions that weren't prefilled that were missing
+        from the pool, and the mean and maximum latency in seconds."""
+        with mininode_lock:
+            reconstructions = list(self.reconstructions)
+        num_shortids = sum(r.num_txs - r.num_prefilled for r in reconstructions)
+        latencies = [r.latency for r in reconstructions]
+        return {
+            "blocks": len(reconstructions),
+            "getblocktxn": sum(1 for r in reconstructions if r.num_missing),
+            "failed": sum(1 for r in reconstructions if not r.success),
+            "missing_tx_rate": sum(r.num_missing for r in reconstructions) / num_shortids if num_shortids else 0.0,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max_latency": max(latencies, default=0.0),
+        }
@@ -7,7 +7,7 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .messages import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
+from .messages import CTxOut, sha256, hash256, ser_compact_size, ser_string
 
 from binascii import hexlify
 import hashlib
@@ -595,6 +595,14 @@ SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
 SIGHASH_ANYONECANPAY = 0x80
 
+ZERO_HASH = bytes(32)
+# What SignatureHash() returns for SIGHASH_SINGLE without a matching output
+HASH_ONE = b'\x01' + bytes(31)
+
+# The serialization of a CTxIn with an empty scriptSig, and of CTxOut(-1)
+EMPTY_TXIN_SIZE = 36 + 1 + 4
+NULL_TXOUT = CTxOut(-1).serialize()
+
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
     r = b''
@@ -613,97 +621,164 @@ def FindAndDelete(script, sig):
     return CScript(r)
 
 
-def SignatureHash(script, txTo, inIdx, hashtype):
+class PrecomputedTransactionData():
+    """The parts of a transaction that its signature hashes share.
+
+    For the legacy SignatureHash(), these are the transaction's inputs with
+    empty scriptSigs (with their own and with zeroed sequences) and its
+    outputs, serialized; the input being signed is spliced into them. For
+    SegwitVersion1SignatureHash(), they are the BIP143 hashes of the
+    transaction's prevouts, sequences and outputs.
+
+    Signing every input of a transaction with the same
+    PrecomputedTransactionData serializes and hashes these once, rather than
+    once per input. Each is computed when first needed. The transaction's
+    inputs (other than their scriptSigs and witnesses) and outputs must not
+    change afterwards."""
+
+    def __init__(self, txTo):
+        self.txTo = txTo
+        self._prevouts = None
+        self._legacy_inputs = None
+        self._legacy_outputs = None
+        self._hashPrevouts = None
+        self._hashSequence = None
+        self._hashOutputs = None
+
+    @property
+    def prevouts(self):
+        if self._prevouts is None:
+            self._prevouts = [i.prevout.serialize() for i in self.txTo.vin]
+        return self._prevouts
+
+    @property
+    def legacy_inputs(self):
+        """The inputs with empty scriptSigs, with their sequences and with zero sequences."""
+        if self._legacy_inputs is None:
+            vin = self.txTo.vin
+            with_sequence = b"".join(p + b"\x00" + struct.pack("<I", i.nSequence) for p, i in zip(self.prevouts, vin))
+            without_sequence = b"".join(p + b"\x00" + bytes(4) for p in self.prevouts)
+            self._legacy_inputs = (memoryview(with_sequence), memoryview(without_sequence))
+        return self._legacy_inputs
+
+    @property
+    def legacy_outputs(self):
+        if self._legacy_outputs is None:
+            vout = self.txTo.vout
+            self._legacy_outputs = ser_compact_size(len(vout)) + b"".join(o.serialize() for o in vout)
+        return self._legacy_outputs
+
+    @property
+    def hashPrevouts(self):
+        if self._hashPrevouts is None:
+            self._hashPrevouts = hash256(b"".join(self.prevouts))
+        return self._hashPrevouts
+
+    @property
+    def hashSequence(self):
+        if self._hashSequence is None:
+            self._hashSequence = hash256(b"".join(struct.pack("<I", i.nSequence) for i in self.txTo.vin))
+        return self._hashSequence
+
+    @property
+    def hashOutputs(self):
+        if self._hashOutputs is None:
+            self._hashOutputs = hash256(b"".join(o.serialize() for o in self.txTo.vout))
+        return self._hashOutputs
+
+    def signature_hash(self, script, inIdx, hashtype, amount):
+        """The BIP143 signature hash of input inIdx, see SegwitVersion1SignatureHash()."""
+        txTo = self.txTo
+        basetype = hashtype & 0x1f
+        anyonecanpay = hashtype & SIGHASH_ANYONECANPAY
+
+        hashPrevouts = ZERO_HASH if anyonecanpay else self.hashPrevouts
+        if anyonecanpay or basetype == SIGHASH_SINGLE or basetype == SIGHASH_NONE:
+            hashSequence = ZERO_HASH
+        else:
+            hashSequence = self.hashSequence
+        if basetype != SIGHASH_SINGLE and basetype != SIGHASH_NONE:
+            hashOutputs = self.hashOutputs
+        elif basetype == SIGHASH_SINGLE and inIdx < len(txTo.vout):
+            hashOutputs = hash256(txTo.vout[inIdx].serialize())
+        else:
+            hashOutputs = ZERO_HASH
+
+        txin = txTo.vin[inIdx]
+        return hash256(b"".join((
+            struct.pack("<i", txTo.nVersion),
+            hashPrevouts,
+            hashSequence,
+            txin.prevout.serialize(),
+            ser_string(script),
+            struct.pack("<q", amount),
+            struct.pack("<I", txin.nSequence),
+            hashOutputs,
+            struct.pack("<i", txTo.nLockTime),
+            struct.pack("<I", hashtype),
+        )))
+
+    def legacy_signature_hash(self, script, inIdx, hashtype):
+        """The legacy signature hash of input inIdx, see SignatureHash()."""
+        txTo = self.txTo
+        if inIdx >= len(txTo.vin):
+            return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+        script_code = ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+
+        basetype = hashtype & 0x1f
+        if basetype == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+            return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
+
+        # Hash the serialization of the transaction with all scriptSigs
+        # emptied, except that of the input being signed, which is the script
+        # code, and with the changes the hashtype calls for.
+        txin = txTo.vin[inIdx]
+        this_input = self.prevouts[inIdx] + script_code + struct.pack("<I", txin.nSequence)
+        h = hashlib.sha256(struct.pack("<i", txTo.nVersion))
+        if hashtype & SIGHASH_ANYONECANPAY:
+            h.update(b"\x01")
+            h.update(this_input)
+        else:
+            with_sequence, without_sequence = self.legacy_inputs
+            inputs = without_sequence if basetype == SIGHASH_NONE or basetype == SIGHASH_SINGLE else with_sequence
+            h.update(ser_compact_size(len(txTo.vin)))
+            h.update(inputs[:EMPTY_TXIN_SIZE * inIdx])
+            h.update(this_input)
+            h.update(inputs[EMPTY_TXIN_SIZE * (inIdx + 1):])
+        if basetype == SIGHASH_NONE:
+            h.update(ser_compact_size(0))
+        elif basetype == SIGHASH_SINGLE:
+            # The outputs before inIdx are replaced by CTxOut(-1)
+            h.update(ser_compact_size(inIdx + 1))
+            h.update(NULL_TXOUT * inIdx)
+            h.update(txTo.vout[inIdx].serialize())
+        else:
+            h.update(self.legacy_outputs)
+        h.update(struct.pack("<I", txTo.nLockTime))
+        h.update(struct.pack("<I", hashtype))
+
+        return (sha256(h.digest()), None)
+
+def SignatureHash(script, txTo, inIdx, hashtype, txdata=None):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
-    """
-    HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-
-    if inIdx >= len(txTo.vin):
-        return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
 
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
-
-    hash = hash256(s)
-
-    return (hash, None)
+    Pass the same PrecomputedTransactionData of txTo as txdata to sign several
+    of its inputs without serializing the whole transaction for each.
+    """
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo)
+    return txdata.legacy_signature_hash(script, inIdx, hashtype)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
-
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
-
-    if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
-
-    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
-
-    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
-
-    return hash256(ss)
+def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, txdata=None):
+    """BIP143 SignatureHash
+
+    Pass the same PrecomputedTransactionData of txTo as txdata to sign several
+    of its inputs without hashing the whole transaction for each."""
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo)
+    return txdata.signature_hash(script, inIdx, hashtype, amount)
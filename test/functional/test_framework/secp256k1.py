@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Pure-Python secp256k1 arithmetic and ECDSA.
+
+Points are kept in Jacobian coordinates (X, Y, Z), standing for the affine
+point (X/Z^2, Y/Z^3), so that adding and doubling them needs no modular
+inversion. None is the point at infinity. Multiples of the generator are
+computed from a table of precomputed multiples, see generator_multiply().
+
+This is not constant-time, and is only meant for testing.
+"""
+
+import hashlib
+import hmac
+
+# The field size, the group order and the generator
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+# generator_multiply() adds one precomputed multiple of G per window of this
+# many bits of the scalar
+G_TABLE_WINDOW = 8
+
+_g_table = None
+
+try:
+    pow(2, -1, 3)
+except ValueError:
+    # Python < 3.8: Fermat's little theorem
+    def modinv(a, m):
+        """The inverse of a modulo the prime m"""
+        return pow(a, m - 2, m)
+else:
+    def modinv(a, m):
+        """The inverse of a modulo the prime m"""
+        return pow(a, -1, m)
+
+def jacobian_double(pt):
+    if pt is None:
+        return None
+    X, Y, Z = pt
+    if Y == 0:
+        return None
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    return (X3, (M * (S - X3) - 8 * YY * YY) % P, 2 * Y * Z % P)
+
+def jacobian_add_affine(pt, x2, y2):
+    """Add the affine point (x2, y2) to the Jacobian point pt."""
+    if pt is None:
+        return (x2, y2, 1)
+    X1, Y1, Z1 = pt
+    Z1Z1 = Z1 * Z1 % P
+    H = (x2 * Z1Z1 - X1) % P
+    R = (y2 * Z1 * Z1Z1 - Y1) % P
+    if H == 0:
+        return jacobian_double(pt) if R == 0 else None
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    return (X3, (R * (V - X3) - Y1 * HHH) % P, Z1 * H % P)
+
+def jacobian_add(p1, p2):
+    if p1 is None:
+        return p2
+    if p2 is None:
+        return p1
+    X1, Y1, Z1 = p1
+    X2, Y2, Z2 = p2
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    S1 = Y1 * Z2 * Z2Z2 % P
+    H = (X2 * Z1Z1 - U1) % P
+    R = (Y2 * Z1 * Z1Z1 - S1) % P
+    if H == 0:
+        return jacobian_double(p1) if R == 0 else None
+    HH = H * H % P
+    HHH = H * HH % P
+    V = U1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    return (X3, (R * (V - X3) - S1 * HHH) % P, Z1 * Z2 * H % P)
+
+def to_affine(pt):
+    if pt is None:
+        return None
+    X, Y, Z = pt
+    zinv = modinv(Z, P)
+    zinv2 = zinv * zinv % P
+    return (X * zinv2 % P, Y * zinv2 * zinv % P)
+
+def _batch_to_affine(points):
+    """Convert non-infinite Jacobian points to affine with a single inversion."""
+    # Montgomery's trick: invert the product of all Z, and recover each
+    # inverse from it and the partial products.
+    partial = []
+    acc = 1
+    for _, _, Z in points:
+        partial.append(acc)
+        acc = acc * Z % P
+    inv = modinv(acc, P)
+    result = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        zinv = inv * partial[i] % P
+        inv = inv * Z % P
+        zinv2 = zinv * zinv % P
+        result[i] = (X * zinv2 % P, Y * zinv2 * zinv % P)
+    return result
+
+def _get_g_table():
+    """table[i][d - 1] is d * 2^(G_TABLE_WINDOW * i) * G in affine coordinates, for 0 < d < 2^G_TABLE_WINDOW."""
+    global _g_table
+    if _g_table is None:
+        points = []
+        base = (G[0], G[1], 1)
+        num_windows = (256 + G_TABLE_WINDOW - 1) // G_TABLE_WINDOW
+        for _ in range(num_windows):
+            base_x, base_y = to_affine(base)
+            multiple = base
+            points.append(multiple)
+            for _ in range(2, 1 << G_TABLE_WINDOW):
+                multiple = jacobian_add_affine(multiple, base_x, base_y)
+                points.append(multiple)
+            base = jacobian_add_affine(multiple, base_x, base_y)
+        affine = _batch_to_affine(points)
+        row = (1 << G_TABLE_WINDOW) - 1
+        _g_table = [affine[i:i + row] for i in range(0, len(affine), row)]
+    return _g_table
+
+def generator_multiply(k):
+    """k * G, as a Jacobian point.
+
+    This takes one addition per window of the scalar and no doublings. The
+    table is computed on first use."""
+    table = _get_g_table()
+    mask = (1 << G_TABLE_WINDOW) - 1
+    pt = None
+    i = 0
+    k %= N
+    while k:
+        d = k & mask
+        if d:
+            x, y = table[i][d - 1]
+            pt = jacobian_add_affine(pt, x, y)
+        k >>= G_TABLE_WINDOW
+        i += 1
+    return pt
+
+def point_multiply(k, point):
+    """k * point for an affine point, as a Jacobian point, with a window of 4 bits."""
+    k %= N
+    if point is None or k == 0:
+        return None
+    x, y = point
+    multiples = [None, (x, y, 1)]
+    for _ in range(14):
+        multiples.append(jacobian_add_affine(multiples[-1], x, y))
+    pt = None
+    for shift in range(((k.bit_length() + 3) // 4 - 1) * 4, -4, -4):
+        for _ in range(4):
+            pt = jacobian_double(pt)
+        pt = jacobian_add(pt, multiples[(k >> shift) & 15])
+    return pt
+
+def lift_x(x, odd):
+    """The affine point with x coordinate x and y of the given parity, or None if there is none."""
+    if x >= P:
+        return None
+    y_sq = (pow(x, 3, P) + 7) % P
+    y = pow(y_sq, (P + 1) // 4, P)
+    if y * y % P != y_sq:
+        return None
+    return (x, P - y if (y & 1) != odd else y)
+
+def is_on_curve(point):
+    x, y = point
+    return x < P and y < P and (y * y - x * x * x - 7) % P == 0
+
+def _rfc6979_nonces(secret, hash):
+    """Generate the deterministic ECDSA nonces of RFC 6979 with HMAC-SHA256."""
+    x = secret.to_bytes(32, 'big')
+    h = (int.from_bytes(hash, 'big') % N).to_bytes(32, 'big')
+    V = b'\x01' * 32
+    K = hmac.new(b'\x00' * 32, V + b'\x00' + x + h, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    K = hmac.new(K, V + b'\x01' + x + h, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    while True:
+        V = hmac.new(K, V, hashlib.sha256).digest()
+        k = int.from_bytes(V, 'big')
+        if 0 < k < N:
+            yield k
+        K = hmac.new(K, V + b'\x00', hashlib.sha256).digest()
+        V = hmac.new(K, V, hashlib.sha256).digest()
+
+def ecdsa_sign(secret, hash):
+    """Sign a 32-byte hash with the secret exponent. Returns (r, s)."""
+    z = int.from_bytes(hash, 'big')
+    for k in _rfc6979_nonces(secret, hash):
+        R = to_affine(generator_multiply(k))
+        r = R[0] % N
+        if r == 0:
+            continue
+        s = modinv(k, N) * (z + r * secret) % N
+        if s != 0:
+            return (r, s)
+
+def ecdsa_verify(point, hash, r, s):
+    """Verify the signature (r, s) of a 32-byte hash with the affine public key point."""
+    if not (0 < r < N and 0 < s < N):
+        return False
+    w = modinv(s, N)
+    z = int.from_bytes(hash, 'big')
+    R = jacobian_add(generator_multiply(z * w), point_multiply(r * w, point))
+    if R is None:
+        return False
+    return to_affine(R)[0] % N == r
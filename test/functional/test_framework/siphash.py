@@ -4,9 +4,19 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Specialized SipHash-2-4 implementations.
 
-This implements SipHash-2-4 for 256-bit integers.
+This implements SipHash-2-4 for 256-bit integers. siphash256_batch() hashes
+many of them with the same key at once, on NumPy uint64 arrays if NumPy is
+installed.
 """
 
+# Below this many hashes, siphash256_batch() doesn't bother with NumPy
+NUMPY_BATCH_MIN = 32
+
+# The numpy module, False if it is not installed, or None before the first
+# batch large enough to use it. Importing it is slow, so it is not done
+# when this module is imported.
+_numpy = None
+
 def rotl64(n, b):
     return n >> (64 - b) | (n & ((1 << (64 - b)) - 1)) << b
 
@@ -61,3 +71,77 @@ def siphash256(k0, k1, h):
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     return v0 ^ v1 ^ v2 ^ v3
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+def _rotl64_array(n, b):
+    return (n << _numpy.uint64(b)) | (n >> _numpy.uint64(64 - b))
+
+def _siphash_round_array(v0, v1, v2, v3):
+    # Same as siphash_round(), on uint64 arrays. Their additions wrap around.
+    v0 += v1
+    v1 = _rotl64_array(v1, 13)
+    v1 ^= v0
+    v0 = _rotl64_array(v0, 32)
+    v2 += v3
+    v3 = _rotl64_array(v3, 16)
+    v3 ^= v2
+    v0 += v3
+    v3 = _rotl64_array(v3, 21)
+    v3 ^= v0
+    v2 += v1
+    v1 = _rotl64_array(v1, 17)
+    v1 ^= v2
+    v2 = _rotl64_array(v2, 32)
+    return (v0, v1, v2, v3)
+
+def _siphash256_array(k0, k1, hashes):
+    np = _numpy
+    data = b''.join(h.to_bytes(32, 'little') for h in hashes)
+    words = np.frombuffer(data, dtype='<u8').reshape(-1, 4).astype(np.uint64)
+    n0, n1, n2, n3 = (words[:, i].copy() for i in range(4))
+    count = len(hashes)
+    v0 = np.full(count, 0x736f6d6570736575 ^ k0, dtype=np.uint64)
+    v1 = np.full(count, 0x646f72616e646f6d ^ k1, dtype=np.uint64)
+    v2 = np.full(count, 0x6c7967656e657261 ^ k0, dtype=np.uint64)
+    v3 = np.full(count, 0x7465646279746573 ^ k1, dtype=np.uint64) ^ n0
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0 ^= n0
+    v3 ^= n1
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0 ^= n1
+    v3 ^= n2
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0 ^= n2
+    v3 ^= n3
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0 ^= n3
+    v3 ^= np.uint64(0x2000000000000000)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0 ^= np.uint64(0x2000000000000000)
+    v2 ^= np.uint64(0xFF)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round_array(v0, v1, v2, v3)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
+
+def siphash256_batch(k0, k1, hashes):
+    """Return [siphash256(k0, k1, h) for h in hashes], vectorized with NumPy if it is installed."""
+    hashes = list(hashes)
+    if len(hashes) >= NUMPY_BATCH_MIN and _get_numpy():
+        return _siphash256_array(k0, k1, hashes)
+    return [siphash256(k0, k1, h) for h in hashes]
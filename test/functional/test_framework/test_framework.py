@@ -6,27 +6,34 @@
 
 import configparser
 from enum import Enum
+import hashlib
+import json
 import logging
 import argparse
 import os
-import pdb
 import shutil
 import sys
 import tempfile
 import time
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from .authproxy import JSONRPCException
 from . import coverage
-from .test_node import TestNode
-from .mininode import NetworkThread
+from .test_node import TestNode, wait_for_rpc_connections
 from .util import (
     MAX_NODES,
     PortSeed,
     assert_equal,
     check_json_precision,
     connect_nodes_bi,
+    copy_datadir,
     disconnect_nodes,
     get_datadir_path,
+    get_dir_size,
     initialize_datadir,
     p2p_port,
     sync_blocks,
@@ -45,6 +52,9 @@ TEST_EXIT_SKIPPED = 77
 
 TMPDIR_PREFIX = "bitcoin_func_test_"
 
+# How much room to leave for a datadir to grow when placing it in --ramdir
+RAM_DATADIR_HEADROOM = 64 * 1024 * 1024
+
 
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
@@ -53,6 +63,46 @@ class SkipTest(Exception):
         self.message = message
 
 
+class ChainFixture():
+    """A named chain state that tests can start their nodes from.
+
+    The first test that uses a fixture builds it: build(test, **params) is
+    called with test.nodes set to num_nodes nodes that were started with
+    extra_args on an empty chain, and should bring them into the state the
+    fixture describes. The nodes' datadirs are then stored in the cache
+    directory, where they are shared by all tests (and, with --keepcache,
+    test runs) that use the same recipe.
+
+    The cache is keyed by a hash of the recipe: the name, num_nodes,
+    extra_args, params and the source code of build. Changing any of them
+    builds a new fixture. Functions called from build are not part of the
+    recipe, so bump a param like "version" when they change in a way that
+    matters.
+
+    The deterministic coinbase keys are imported into the nodes' wallets
+    before build is called, so that blocks mined with generate() can be
+    spent. build should leave the nodes on the same tip: like the cached
+    chain, the fixture's tip ages, so setup_nodes() mines a block with the
+    current time on top of it to take the nodes out of initial block
+    download."""
+
+    def __init__(self, name, build, *, num_nodes, extra_args=None, params=None):
+        self.name = name
+        self.build = build
+        self.num_nodes = num_nodes
+        self.extra_args = [[]] * num_nodes if extra_args is None else extra_args
+        self.params = {} if params is None else params
+        assert_equal(len(self.extra_args), num_nodes)
+
+    def recipe_hash(self):
+        import inspect
+        recipe = [self.name, self.num_nodes, self.extra_args, sorted(self.params.items()), inspect.getsource(self.build)]
+        return hashlib.sha256(json.dumps(recipe).encode('utf-8')).hexdigest()
+
+    def get_cache_dir(self, cachedir):
+        return os.path.join(cachedir, "fixtures", "{}-{}".format(self.name, self.recipe_hash()[:16]))
+
+
 class BitcoinTestMetaClass(type):
     """Metaclass for BitcoinTestFramework.
 
@@ -92,6 +142,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def __init__(self):
         """Sets test framework defaults. Do not override this method. Instead, override the set_test_params() method"""
         self.setup_clean_chain = False
+        self.chain_fixture = None
         self.nodes = []
         self.network_thread = None
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
@@ -112,6 +163,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         parser.add_argument("--cachedir", dest="cachedir", default=os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../../cache"),
                             help="Directory for caching pregenerated datadirs (default: %(default)s)")
         parser.add_argument("--tmpdir", dest="tmpdir", help="Root directory for datadirs")
+        parser.add_argument("--ramdir", dest="ramdir",
+                            help="Put the nodes' datadirs in this RAM-backed directory (e.g. /dev/shm) as long as they fit in --rambudget, linked from the tmpdir. Datadirs that don't fit go in the tmpdir.")
+        parser.add_argument("--rambudget", dest="rambudget", default=1024, type=int,
+                            help="How much memory, in MiB, the test's datadirs in --ramdir may use (default: %(default)s)")
         parser.add_argument("-l", "--loglevel", dest="loglevel", default="INFO",
                             help="log events at this level and higher to the console. Can be set to DEBUG, INFO, WARNING, ERROR or CRITICAL. Passing --loglevel DEBUG will output all logs to console. Note that logs at all levels are always written to the test_framework.log file in the temporary test directory.")
         parser.add_argument("--tracerpc", dest="trace_rpc", default=False, action="store_true",
@@ -129,11 +184,17 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                             help="use bvault-cli instead of RPC for all commands")
         parser.add_argument("--perf", dest="perf", default=False, action="store_true",
                             help="profile running nodes with perf for the duration of the test")
+        parser.add_argument("--eccbackend", dest="eccbackend", choices=["openssl", "python"],
+                            help="Implementation of the keys the test framework creates (default: openssl if libssl supports secp256k1, python otherwise)")
         self.add_options(parser)
         self.options = parser.parse_args()
 
         PortSeed.n = self.options.port_seed
 
+        if self.options.eccbackend:
+            from .key import set_backend
+            set_backend(self.options.eccbackend)
+
         check_json_precision()
 
         self.options.cachedir = os.path.abspath(self.options.cachedir)
@@ -158,9 +219,19 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             self.options.tmpdir = tempfile.mkdtemp(prefix=TMPDIR_PREFIX)
         self._start_logging()
 
-        self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
-        self.network_thread.start()
+        self.ramdir = None
+        self.ram_bytes_reserved = 0
+        if self.options.ramdir:
+            self.ramdir = tempfile.mkdtemp(prefix=TMPDIR_PREFIX, dir=os.path.abspath(self.options.ramdir))
+            self.log.debug("Placing datadirs in {} where they fit in {} MiB".format(self.ramdir, self.options.rambudget))
+
+        # Only tests that import mininode can make P2P connections, so the
+        # others need neither the network thread nor asyncio.
+        if 'test_framework.mininode' in sys.modules:
+            from .mininode import NetworkThread
+            self.log.debug('Setting up network thread')
+            self.network_thread = NetworkThread()
+            self.network_thread.start()
 
         success = TestStatus.FAILED
 
@@ -189,11 +260,13 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             self.log.warning("Exiting after keyboard interrupt")
 
         if success == TestStatus.FAILED and self.options.pdbonfailure:
+            import pdb
             print("Testcase failed. Attaching python debugger. Enter ? for help")
             pdb.set_trace()
 
-        self.log.debug('Closing down network thread')
-        self.network_thread.close()
+        if self.network_thread:
+            self.log.debug('Closing down network thread')
+            self.network_thread.close()
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
             if self.nodes:
@@ -203,6 +276,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                 node.cleanup_on_exit = False
             self.log.info("Note: bvaultds were not stopped and may still be running")
 
+        self._report_bytes_written()
+
         should_clean_up = (
             not self.options.nocleanup and
             not self.options.noshutdown and
@@ -229,6 +304,13 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             self.log.error("Test failed. Test logging available at %s/test_framework.log", self.options.tmpdir)
             self.log.error("Hint: Call {} '{}' to consolidate all logs".format(os.path.normpath(os.path.dirname(os.path.realpath(__file__)) + "/../combine_logs.py"), self.options.tmpdir))
             exit_code = TEST_EXIT_FAILED
+        if self.ramdir is not None:
+            if cleanup_tree_on_exit:
+                shutil.rmtree(self.ramdir)
+            elif not self.options.noshutdown:
+                self._move_ram_datadirs_to_disk()
+            else:
+                self.log.warning("Not cleaning up dir {}".format(self.ramdir))
         logging.shutdown()
         if cleanup_tree_on_exit:
             shutil.rmtree(self.options.tmpdir)
@@ -250,7 +332,9 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def setup_chain(self):
         """Override this method to customize blockchain setup"""
         self.log.info("Initializing test directory " + self.options.tmpdir)
-        if self.setup_clean_chain:
+        if self.chain_fixture is not None:
+            self._initialize_chain_from_fixture()
+        elif self.setup_clean_chain:
             self._initialize_chain_clean()
         else:
             self._initialize_chain()
@@ -275,8 +359,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.start_nodes()
         self.import_deterministic_coinbase_privkeys()
         if not self.setup_clean_chain:
-            for n in self.nodes:
-                assert_equal(n.getblockchaininfo()["blocks"], 199)
+            if self.chain_fixture is None:
+                for n in self.nodes:
+                    assert_equal(n.getblockchaininfo()["blocks"], 199)
+            height = self.nodes[0].getblockcount()
             # To ensure that all nodes are out of IBD, the most recent block
             # must have a timestamp not too old (see IsInitialBlockDownload()).
             self.log.debug('Generate a block with current time')
@@ -285,7 +371,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             for n in self.nodes:
                 n.submitblock(block)
                 chain_info = n.getblockchaininfo()
-                assert_equal(chain_info["blocks"], 200)
+                assert_equal(chain_info["blocks"], height + 1)
                 assert_equal(chain_info["initialblockdownload"], False)
 
     def import_deterministic_coinbase_privkeys(self):
@@ -321,9 +407,13 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         assert_equal(len(extra_args), num_nodes)
         assert_equal(len(binary), num_nodes)
         for i in range(num_nodes):
+            datadir = get_datadir_path(self.options.tmpdir, i)
+            if os.path.islink(datadir):
+                # Let the node (and the test) use the datadir in --ramdir directly
+                datadir = os.readlink(datadir)
             self.nodes.append(TestNode(
                 i,
-                get_datadir_path(self.options.tmpdir, i),
+                datadir,
                 rpchost=rpchost,
                 timewait=self.rpc_timeout,
                 bvaultd=binary[i],
@@ -356,8 +446,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         try:
             for i, node in enumerate(self.nodes):
                 node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            wait_for_rpc_connections(self.nodes)
         except:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -483,11 +572,14 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                     cwd=self.options.tmpdir,
                 ))
                 self.nodes[i].args = args
-                self.start_node(i)
+                self.nodes[i].start()
 
             # Wait for RPC connections to be ready
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            wait_for_rpc_connections(self.nodes)
+
+            if self.options.coveragedir is not None:
+                for node in self.nodes:
+                    coverage.write_all_rpc_commands(self.options.coveragedir, node.rpc)
 
             # Create a 199-block-long chain; each of the 4 first nodes
             # gets 25 mature blocks and 25 immature.
@@ -515,11 +607,75 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                     if entry not in ['chainstate', 'blocks']:
                         os.remove(cache_path(i, entry))
 
+        self._copy_cached_datadirs(self.options.cachedir)
+
+    def _initialize_chain_from_fixture(self):
+        """Initialize the blockchain from self.chain_fixture, building the fixture in the cache first if needed."""
+        fixture = self.chain_fixture
+        assert self.num_nodes <= fixture.num_nodes
+        fixture_dir = fixture.get_cache_dir(self.options.cachedir)
+        if not os.path.isdir(fixture_dir):
+            self._build_chain_fixture(fixture, fixture_dir)
+        self._copy_cached_datadirs(fixture_dir)
+
+    def _build_chain_fixture(self, fixture, fixture_dir):
+        self.log.info("Building chain fixture {} in {}".format(fixture.name, fixture_dir))
+        os.makedirs(os.path.dirname(fixture_dir), exist_ok=True)
+        # Build next to the final location, so that a test running in
+        # parallel never sees a half-built fixture
+        build_dir = tempfile.mkdtemp(prefix=os.path.basename(fixture_dir) + ".", dir=os.path.dirname(fixture_dir))
+        for i in range(fixture.num_nodes):
+            datadir = initialize_datadir(build_dir, i)
+            self.nodes.append(TestNode(
+                i,
+                datadir,
+                extra_conf=["bind=127.0.0.1"],
+                extra_args=fixture.extra_args[i],
+                rpchost=None,
+                timewait=self.rpc_timeout,
+                bvaultd=self.options.bvaultd,
+                bitcoin_cli=self.options.bitcoincli,
+                coverage_dir=None,
+                cwd=self.options.tmpdir,
+            ))
+            self.nodes[i].start()
+        wait_for_rpc_connections(self.nodes)
+        if self.options.coveragedir is not None:
+            for node in self.nodes:
+                coverage.write_all_rpc_commands(self.options.coveragedir, node.rpc)
+        self.import_deterministic_coinbase_privkeys()
+        fixture.build(self, **fixture.params)
+        self.stop_nodes()
+        self.nodes = []
+
+        # Remove what is specific to the run that built the fixture
+        for i in range(fixture.num_nodes):
+            datadir = get_datadir_path(build_dir, i)
+            for output_dir in ('stdout', 'stderr'):
+                for entry in os.listdir(os.path.join(datadir, output_dir)):
+                    os.remove(os.path.join(datadir, output_dir, entry))
+            for entry in ['debug.log', 'peers.dat', 'banlist.dat']:
+                if os.path.isfile(os.path.join(datadir, 'regtest', entry)):
+                    os.remove(os.path.join(datadir, 'regtest', entry))
+
+        try:
+            os.rename(build_dir, fixture_dir)
+        except OSError:
+            # Another test built the same fixture first
+            shutil.rmtree(build_dir)
+
+    def _copy_cached_datadirs(self, cache_dir):
+        """Create num_nodes datadirs in the test directory from the datadirs in cache_dir."""
+        start_time = time.time()
+        bytes_copied = 0
         for i in range(self.num_nodes):
-            from_dir = get_datadir_path(self.options.cachedir, i)
-            to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(from_dir, to_dir)
+            from_dir = get_datadir_path(cache_dir, i)
+            to_dir = self._place_datadir(i, get_dir_size(from_dir))
+            stats = copy_datadir(from_dir, to_dir)
+            self.log.debug("Copied cached datadir for node {}: {linked} files linked, {reflinked} reflinked, {copied} copied ({bytes_copied} bytes)".format(i, **stats))
+            bytes_copied += stats["bytes_copied"]
             initialize_datadir(self.options.tmpdir, i)  # Overwrite port/rpcport in bvault.conf
+        self.log.debug("Copied cached datadirs in {:.3f}s, writing {} bytes".format(time.time() - start_time, bytes_copied))
 
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
@@ -527,8 +683,59 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         Create an empty blockchain and num_nodes wallets.
         Useful if a test case wants complete control over initialization."""
         for i in range(self.num_nodes):
+            self._place_datadir(i, 0)
             initialize_datadir(self.options.tmpdir, i)
 
+    def _place_datadir(self, i, size):
+        """Choose where node i's datadir goes and return that path. Nothing is created there yet.
+
+        With --ramdir, a datadir of the given initial size goes in the ramdir
+        if it fits in the budget (with some room to grow) and in the free space
+        there. It is then linked from the tmpdir, so that paths into the tmpdir
+        keep working."""
+        datadir = get_datadir_path(self.options.tmpdir, i)
+        if self.ramdir is None:
+            return datadir
+        reserve = size + RAM_DATADIR_HEADROOM
+        if self.ram_bytes_reserved + reserve > self.options.rambudget * 1024 * 1024 or reserve > shutil.disk_usage(self.ramdir).free:
+            self.log.debug("Node {}'s datadir doesn't fit in {}, putting it in {}".format(i, self.ramdir, datadir))
+            return datadir
+        self.ram_bytes_reserved += reserve
+        ram_datadir = get_datadir_path(self.ramdir, i)
+        os.symlink(ram_datadir, datadir)
+        return ram_datadir
+
+    def _move_ram_datadirs_to_disk(self):
+        """Replace the links to datadirs in --ramdir by the datadirs, to keep them for inspection without holding on to the memory."""
+        for entry in os.listdir(self.options.tmpdir):
+            link = os.path.join(self.options.tmpdir, entry)
+            if os.path.islink(link) and os.readlink(link).startswith(self.ramdir):
+                target = os.readlink(link)
+                os.unlink(link)
+                if os.path.isdir(target):
+                    shutil.move(target, link)
+        shutil.rmtree(self.ramdir)
+
+    def _report_bytes_written(self):
+        """Log how much the stopped nodes wrote to disk, and how big their datadirs are."""
+        in_ram = on_disk = 0
+        for i in range(self.num_nodes):
+            datadir = get_datadir_path(self.options.tmpdir, i)
+            if os.path.isdir(datadir):
+                if os.path.islink(datadir):
+                    in_ram += get_dir_size(datadir)
+                else:
+                    on_disk += get_dir_size(datadir)
+        message = "Datadirs use {} bytes on disk and {} bytes in RAM".format(on_disk, in_ram)
+        if resource is not None:
+            # Only counts processes that have been waited for, i.e. stopped nodes
+            blocks = resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock
+            message += "; nodes wrote {} bytes to block devices".format(blocks * 512)
+        if self.ramdir is not None:
+            self.log.info(message)
+        else:
+            self.log.debug(message)
+
     def skip_if_no_py3_zmq(self):
         """Attempt to import the zmq package and skip the test if the import fails."""
         try:
@@ -8,6 +8,7 @@ import contextlib
 import decimal
 import errno
 from enum import Enum
+import hashlib
 import http.client
 import json
 import logging
@@ -35,6 +36,13 @@ from .util import (
 JSONDecodeError = getattr(json, "JSONDecodeError", ValueError)
 
 BVAULTD_PROC_WAIT_TIMEOUT = 60
+# bvaultd logs this once RPC warmup has finished
+INIT_DONE_LOG_MSG = b"init message: Done loading"
+# How often wait_for_rpc_connections() checks the nodes' debug logs, and how
+# often it tries an RPC call to a node whose debug log hasn't said it is ready
+# (e.g. because it logs somewhere else)
+DEBUG_LOG_POLL_INTERVAL = 0.02
+RPC_RETRY_INTERVAL = 0.25
 
 
 class FailedToStartError(Exception):
@@ -102,6 +110,7 @@ class TestNode():
         self.rpc_connected = False
         self.rpc = None
         self.url = None
+        self.debug_log_path = os.path.join(self.datadir, 'regtest', 'debug.log')
         self.log = logging.getLogger('TestFramework.node%d' % i)
         self.cleanup_on_exit = True # Whether to kill the node when this object goes away
         # Cache perf subprocesses here by their data output filename.
@@ -124,7 +133,16 @@ class TestNode():
             AddressKeyPair('mumwTaMtbxEPUswmLBBN3vM9oGRtGBrys8', 'cSXmRKXVcoouhNNVpcNKFfxsTsToY5pvB9DVsFksF1ENunTzRKsy'),
             AddressKeyPair('mpV7aGShMkJCZgbW7F6iZgrvuPHjZjH9qg', 'cSoXt6tm3pqy43UMabY6eUTmR3eSUYFtB2iNQDGgb3VUnRsQys2k'),
         ]
-        return PRIV_KEYS[self.index]
+        if self.index < len(PRIV_KEYS):
+            return PRIV_KEYS[self.index]
+        # Derive a key for nodes beyond the list above
+        from .address import byte_to_base58, key_to_p2pkh
+        from .key import CECKey
+        secret = hashlib.sha256(("testnode%d" % self.index).encode('ascii')).digest()
+        key = CECKey()
+        key.set_secretbytes(secret)
+        key.set_compressed(True)
+        return AddressKeyPair(key_to_p2pkh(key.get_pubkey()), byte_to_base58(secret + b'\x01', 239))
 
     def get_mem_rss_kilobytes(self):
         """Get the memory usage (RSS) per `ps`.
@@ -192,6 +210,15 @@ class TestNode():
         # potentially interfere with our attempt to authenticate
         delete_cookie_file(self.datadir)
 
+        # Only look for the init message in what this run of bvaultd logs
+        try:
+            self._debug_log_pos = os.path.getsize(self.debug_log_path)
+        except OSError:
+            self._debug_log_pos = 0
+        self._debug_log_tail = b""
+        self._init_done_logged = False
+        self._next_rpc_attempt = 0
+
         # add environment variable LIBC_FATAL_STDERR_=1 so that libc errors are written to stderr and not the terminal
         subp_env = dict(os.environ, LIBC_FATAL_STDERR_="1")
 
@@ -204,37 +231,66 @@ class TestNode():
             self._start_perf()
 
     def wait_for_rpc_connection(self):
-        """Sets up an RPC connection to the bvaultd process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
-            if self.process.poll() is not None:
-                raise FailedToStartError(self._node_msg(
-                    'bvaultd exited with status {} during initialization'.format(self.process.returncode)))
-            try:
-                rpc = get_rpc_proxy(rpc_url(self.datadir, self.index, self.rpchost), self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir)
-                rpc.getblockcount()
-                # If the call to getblockcount() succeeds then the RPC connection is up
-                self.log.debug("RPC successfully started")
-                if self.use_cli:
-                    return
-                self.rpc = rpc
-                self.rpc_connected = True
-                self.url = self.rpc.url
-                return
-            except IOError as e:
-                if e.errno != errno.ECONNREFUSED:  # Port not yet open?
-                    raise  # unknown IO error
-            except JSONRPCException as e:  # Initialization phase
-                # -28 RPC in warmup
-                # -342 Service unavailable, RPC server started but is shutting down due to error
-                if e.error['code'] != -28 and e.error['code'] != -342:
-                    raise  # unknown JSON RPC exception
-            except ValueError as e:  # cookie file not found and no rpcuser or rpcassword. bvaultd still starting
-                if "No RPC credentials" not in str(e):
-                    raise
-            time.sleep(1.0 / poll_per_s)
-        self._raise_assertion_error("Unable to connect to bvaultd")
+        """Sets up an RPC connection to the bvaultd process."""
+        wait_for_rpc_connections([self])
+
+    def _check_debug_log(self):
+        """Return True the first time the init done message shows up in debug.log since the node was started."""
+        if self._init_done_logged:
+            return False
+        try:
+            with open(self.debug_log_path, 'rb') as dl:
+                dl.seek(0, 2)
+                if dl.tell() < self._debug_log_pos:
+                    # debug.log was shrunk on startup
+                    self._debug_log_pos = 0
+                dl.seek(self._debug_log_pos)
+                data = dl.read()
+        except FileNotFoundError:
+            return False
+        self._debug_log_pos += len(data)
+        # Keep enough of the previous read to match a message split across reads
+        data = self._debug_log_tail + data
+        self._debug_log_tail = data[-len(INIT_DONE_LOG_MSG):]
+        self._init_done_logged = INIT_DONE_LOG_MSG in data
+        return self._init_done_logged
+
+    def _try_rpc_connection(self):
+        """Try to set up an RPC connection to the bvaultd process.
+
+        An RPC call is only made once bvaultd has logged that it is done
+        loading, or otherwise every RPC_RETRY_INTERVAL seconds. Returns True if
+        the connection is up."""
+        if self.process.poll() is not None:
+            raise FailedToStartError(self._node_msg(
+                'bvaultd exited with status {} during initialization'.format(self.process.returncode)))
+        now = time.time()
+        if not self._check_debug_log() and now < self._next_rpc_attempt:
+            return False
+        self._next_rpc_attempt = now + RPC_RETRY_INTERVAL
+        try:
+            rpc = get_rpc_proxy(rpc_url(self.datadir, self.index, self.rpchost), self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir)
+            rpc.getblockcount()
+            # If the call to getblockcount() succeeds then the RPC connection is up
+            self.log.debug("RPC successfully started")
+            if self.use_cli:
+                return True
+            self.rpc = rpc
+            self.rpc_connected = True
+            self.url = self.rpc.url
+            return True
+        except IOError as e:
+            if e.errno != errno.ECONNREFUSED:  # Port not yet open?
+                raise  # unknown IO error
+        except JSONRPCException as e:  # Initialization phase
+            # -28 RPC in warmup
+            # -342 Service unavailable, RPC server started but is shutting down due to error
+            if e.error['code'] != -28 and e.error['code'] != -342:
+                raise  # unknown JSON RPC exception
+        except ValueError as e:  # cookie file not found and no rpcuser or rpcassword. bvaultd still starting
+            if "No RPC credentials" not in str(e):
+                raise
+        return False
 
     def generate(self, nblocks, maxtries=1000000):
         self.log.debug("TestNode.generate() dispatches `generate` call to `generatetoaddress`")
@@ -493,6 +549,24 @@ class TestNode():
             p.peer_disconnect()
         del self.p2ps[:]
 
+def wait_for_rpc_connections(nodes):
+    """Sets up RPC connections to started bvaultd processes, as each becomes ready.
+
+    Rather than polling RPC, this watches the nodes' debug logs for the message
+    bvaultd logs when it is done loading, so all nodes are waited for at once
+    and each is connected to as soon as it is ready."""
+    deadlines = {node: time.time() + node.rpc_timeout for node in nodes}
+    pending = list(nodes)
+    while pending:
+        for node in list(pending):
+            if node._try_rpc_connection():
+                pending.remove(node)
+            elif time.time() > deadlines[node]:
+                node._raise_assertion_error("Unable to connect to bvaultd")
+        if pending:
+            time.sleep(DEBUG_LOG_POLL_INTERVAL)
+
+
 class TestNodeCLIAttr:
     def __init__(self, cli, command):
         self.cli = cli
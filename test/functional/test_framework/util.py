@@ -6,17 +6,26 @@
 
 from base64 import b64encode
 from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, ROUND_DOWN
 import hashlib
-import inspect
 import json
 import logging
 import os
 import random
 import re
+import shutil
+import socket
 from subprocess import CalledProcessError
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
 
@@ -202,16 +211,30 @@ def satoshi_round(amount):
     return Decimal(amount).quantize(Decimal('0.00000001'), rounding=ROUND_DOWN)
 
 def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None):
+    """Wait until predicate() is true, re-evaluating it every 0.05 seconds.
+
+    If lock is a threading.Condition (as mininode_lock is), predicate() is also
+    re-evaluated as soon as another thread notifies the condition, instead of
+    only at the next poll. Either way, an attempt is one 0.05 second poll
+    interval, however many notifications arrive in it, so attempts limits
+    the waiting time to attempts * 0.05 seconds."""
     if attempts == float('inf') and timeout == float('inf'):
         timeout = 60
     attempt = 0
     time_end = time.time() + timeout
+    next_attempt = time.time() + 0.05
 
     while attempt < attempts and time.time() < time_end:
         if lock:
             with lock:
                 if predicate():
                     return
+                if isinstance(lock, threading.Condition):
+                    lock.wait(timeout=max(next_attempt - time.time(), 0))
+                    if time.time() >= next_attempt:
+                        attempt += 1
+                        next_attempt = time.time() + 0.05
+                    continue
         else:
             if predicate():
                 return
@@ -219,6 +242,7 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=N
         time.sleep(0.05)
 
     # Print the cause of the timeout
+    import inspect
     predicate_source = inspect.getsourcelines(predicate)
     logger.error("wait_until() failed. Predicate: {}".format(predicate_source))
     if attempt >= attempts:
@@ -236,11 +260,19 @@ MAX_NODES = 8
 PORT_MIN = 11000
 # The number of ports to "reserve" for p2p and rpc, each
 PORT_RANGE = 5000
+# Where the lock files are that reserve ports for concurrently running tests
+PORT_LOCK_DIR = os.path.join(tempfile.gettempdir(), "bitcoin_func_test_ports")
 
 class PortSeed:
     # Must be initialized with a unique integer for each process
     n = None
 
+# Ports handed out by p2p_port() and rpc_port() in this process, by (kind, node number)
+_assigned_ports = {}
+# Locked files reserving the ports this process uses, by port. The locks are
+# released by the OS when the process exits, however it exits.
+_port_locks = {}
+
 def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
     """
     Args:
@@ -266,12 +298,77 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
 
     return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
 
+# Shared thread pool for concurrent RPC calls
+_rpc_executor = None
+
+def rpc_async(method, *args, **kwargs):
+    """Call an RPC method (eg node.getbestblockhash) on a background thread.
+
+    Returns a concurrent.futures.Future for the result. Each node's RPC proxy
+    pools its HTTP connections, so calls may be issued to the same or to
+    different nodes concurrently."""
+    global _rpc_executor
+    if _rpc_executor is None:
+        _rpc_executor = ThreadPoolExecutor(max_workers=2 * MAX_NODES)
+    return _rpc_executor.submit(method, *args, **kwargs)
+
+def rpc_fanout(rpc_connections, method, *args, **kwargs):
+    """Call the named RPC method with the same arguments on all given nodes concurrently.
+
+    Returns the results in the order of rpc_connections. If any call raises,
+    the first such exception is re-raised once all calls have finished."""
+    futures = [rpc_async(getattr(rpc, method), *args, **kwargs) for rpc in rpc_connections]
+    for f in futures:
+        f.exception()
+    return [f.result() for f in futures]
+
+def _reserve_port(port):
+    """Reserve port for this process, unless another test process has or it is in use."""
+    lock = None
+    if fcntl is not None:
+        try:
+            os.makedirs(PORT_LOCK_DIR, exist_ok=True)
+            lock = open(os.path.join(PORT_LOCK_DIR, "%d.lock" % port), 'a', encoding='utf8')
+        except OSError:
+            pass  # Can't share reservations, rely on the bind check
+        else:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return False
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            if lock is not None:
+                lock.close()
+            return False
+    _port_locks[port] = lock
+    return True
+
+def _assign_port(kind, range_start, n):
+    """Return the port of the given kind for node n, reserving one the first time.
+
+    The port PortSeed.n and n point to is tried first, then the ports after it
+    in the range, so tests running in parallel, or with more than MAX_NODES
+    nodes, never get the same port."""
+    if (kind, n) not in _assigned_ports:
+        offset = n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+        for i in range(PORT_RANGE):
+            port = range_start + (offset + i) % PORT_RANGE
+            if port not in _port_locks and _reserve_port(port):
+                break
+        else:
+            raise AssertionError("No free %s port left in %d-%d" % (kind, range_start, range_start + PORT_RANGE - 1))
+        _assigned_ports[(kind, n)] = port
+    return _assigned_ports[(kind, n)]
+
 def p2p_port(n):
-    assert(n <= MAX_NODES)
-    return PORT_MIN + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+    return _assign_port("p2p", PORT_MIN, n)
 
 def rpc_port(n):
-    return PORT_MIN + PORT_RANGE + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+    return _assign_port("rpc", PORT_MIN + PORT_RANGE, n)
 
 def rpc_url(datadir, i, rpchost=None):
     rpc_u, rpc_p = get_auth_cookie(datadir)
@@ -291,7 +388,9 @@ def rpc_url(datadir, i, rpchost=None):
 def initialize_datadir(dirname, n):
     datadir = get_datadir_path(dirname, n)
     if not os.path.isdir(datadir):
-        os.makedirs(datadir)
+        # The datadir may be a link to a directory that doesn't exist yet
+        # (see BitcoinTestFramework._place_datadir)
+        os.makedirs(os.path.realpath(datadir))
     with open(os.path.join(datadir, "bvault.conf"), 'w', encoding='utf8') as f:
         f.write("regtest=1\n")
         f.write("[regtest]\n")
@@ -309,6 +408,69 @@ def initialize_datadir(dirname, n):
 def get_datadir_path(dirname, n):
     return os.path.join(dirname, "node" + str(n))
 
+# Linux ioctl that makes a file share the data of another one until either is
+# written to (a reflink), on filesystems like btrfs and xfs
+FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            return False
+    shutil.copystat(src, dst)
+    return True
+
+def _immutable_datadir_files(filenames):
+    """Return the names of the files in one datadir directory that bvaultd never modifies.
+
+    LevelDB never modifies its table files once they are written, and bvaultd
+    only appends blocks and undo data to the last blk/rev file."""
+    immutable = {name for name in filenames if name.endswith((".ldb", ".sst"))}
+    for prefix in ("blk", "rev"):
+        block_files = sorted(name for name in filenames if name.startswith(prefix) and name.endswith(".dat"))
+        immutable.update(block_files[:-1])
+    return immutable
+
+def get_dir_size(path):
+    """Return the total size of the files under path, in bytes."""
+    return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, _, filenames in os.walk(path) for name in filenames)
+
+def copy_datadir(from_dir, to_dir):
+    """Copy a datadir, sharing as much of the data with the original as is safe.
+
+    Files bvaultd never modifies are hardlinked. All other files are reflinked
+    if the filesystem supports it, and copied otherwise, so the original is not
+    affected by a node running on the copy.
+
+    Returns a dict with the number of files that were 'linked', 'reflinked'
+    and 'copied', and the number of 'bytes_copied'."""
+    stats = dict.fromkeys(("linked", "reflinked", "copied", "bytes_copied"), 0)
+    for dirpath, _, filenames in os.walk(from_dir):
+        dest = os.path.normpath(os.path.join(to_dir, os.path.relpath(dirpath, from_dir)))
+        os.makedirs(dest)
+        shutil.copystat(dirpath, dest)
+        immutable = _immutable_datadir_files(filenames)
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dest, name)
+            if name in immutable:
+                try:
+                    os.link(src, dst)
+                    stats["linked"] += 1
+                    continue
+                except OSError:
+                    pass  # e.g. on another filesystem
+            if _reflink(src, dst):
+                stats["reflinked"] += 1
+            else:
+                shutil.copy2(src, dst)
+                stats["copied"] += 1
+                stats["bytes_copied"] += os.path.getsize(dst)
+    return stats
+
 def append_config(datadir, options):
     with open(os.path.join(datadir, "bvault.conf"), 'a', encoding='utf8') as f:
         for option in options:
@@ -385,7 +547,7 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     """
     stop_time = time.time() + timeout
     while time.time() <= stop_time:
-        best_hash = [x.getbestblockhash() for x in rpc_connections]
+        best_hash = rpc_fanout(rpc_connections, "getbestblockhash")
         if best_hash.count(best_hash[0]) == len(rpc_connections):
             return
         time.sleep(wait)
@@ -398,11 +560,10 @@ def sync_mempools(rpc_connections, *, wait=1, timeout=60, flush_scheduler=True):
     """
     stop_time = time.time() + timeout
     while time.time() <= stop_time:
-        pool = [set(r.getrawmempool()) for r in rpc_connections]
+        pool = [set(m) for m in rpc_fanout(rpc_connections, "getrawmempool")]
         if pool.count(pool[0]) == len(rpc_connections):
             if flush_scheduler:
-                for r in rpc_connections:
-                    r.syncwithvalidationinterfacequeue()
+                rpc_fanout(rpc_connections, "syncwithvalidationinterfacequeue")
             return
         time.sleep(wait)
     raise AssertionError("Mempool sync timed out:{}".format("".join("\n  {!r}".format(m) for m in pool)))
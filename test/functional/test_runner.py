@@ -16,13 +16,18 @@ import argparse
 from collections import deque
 import configparser
 import datetime
+import json
+import multiprocessing
 import os
+import queue
+import runpy
 import time
 import shutil
 import signal
 import sys
 import subprocess
 import tempfile
+import threading
 import re
 import logging
 
@@ -66,6 +71,13 @@ if os.name != 'nt' or sys.getwindowsversion() >= (10, 0, 14393):
 TEST_EXIT_PASSED = 0
 TEST_EXIT_SKIPPED = 77
 
+# Durations of earlier test runs, kept next to (not in) the cache directory,
+# which is flushed on startup
+TIMING_FILE = "functional_test_timings.json"
+
+# Rough resident memory of one regtest bvaultd, to budget how many can run at once
+NODE_MEMORY_ESTIMATE = 200 * 1024 * 1024
+
 BASE_SCRIPTS = [
     # Scripts that are run by the travis build process.
     # Longest test should go first, to favor running tests in parallel
@@ -205,8 +217,27 @@ EXTENDED_SCRIPTS = [
 # Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
 ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
+# Scripts that need an interpreter of their own, e.g. because they start
+# processes with multiprocessing or change interpreter-wide state (the ECC
+# backend, the shared executors, sys.path, signal handlers) at import time.
+# --forkserver runs them as usual. None of the current scripts do: the backend
+# is chosen per test by --eccbackend, and the executors are only created once
+# a test runs, after the fork.
+FRESH_INTERPRETER_SCRIPTS = [
+]
+
+# Modules the forkserver imports once, instead of every test importing them
+FORKSERVER_PRELOAD = [
+    '__main__',
+    'test_framework.test_framework',
+    'test_framework.blocktools',
+    'test_framework.mininode',
+    'test_framework.script',
+]
+
 NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
+    "bench_framework.py",
     "combine_logs.py",
     "create_cache.py",
     "test_runner.py",
@@ -227,6 +258,9 @@ def main():
     parser.add_argument('--extended', action='store_true', help='run the extended test suite in addition to the basic tests')
     parser.add_argument('--help', '-h', '-?', action='store_true', help='print help text and exit')
     parser.add_argument('--jobs', '-j', type=int, default=4, help='how many test scripts to run in parallel. Default=4.')
+    parser.add_argument('--maxnodes', type=int, default=0, help='how many bvaultd processes the tests running in parallel may start in total. Tests are only started when their nodes fit. Default: based on the number of CPUs and the available memory.')
+    parser.add_argument('--forkserver', action='store_true', help='run the tests in processes forked from a server that has the test framework imported already, instead of in new interpreters (Unix only)')
+    parser.add_argument('--pincpus', action='store_true', help='pin each test and its nodes to its own set of CPUs (Linux only)')
     parser.add_argument('--keepcache', '-k', action='store_true', help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
     parser.add_argument('--quiet', '-q', action='store_true', help='only print dots, results summary and failure logs')
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
@@ -305,6 +339,14 @@ def main():
     check_script_list(src_dir=config["environment"]["SRCDIR"], fail_on_warn=args.ci)
     check_script_prefixes()
 
+    if args.pincpus and not hasattr(os, 'sched_setaffinity'):
+        print("{}WARNING!{} --pincpus is not supported on this platform.".format(BOLD[1], BOLD[0]))
+        args.pincpus = False
+
+    if args.forkserver and 'forkserver' not in multiprocessing.get_all_start_methods():
+        print("{}WARNING!{} --forkserver is not supported on this platform.".format(BOLD[1], BOLD[0]))
+        args.forkserver = False
+
     if not args.keepcache:
         shutil.rmtree("%s/test/cache" % config["environment"]["BUILDDIR"], ignore_errors=True)
 
@@ -314,6 +356,9 @@ def main():
         build_dir=config["environment"]["BUILDDIR"],
         tmpdir=tmpdir,
         jobs=args.jobs,
+        max_nodes=args.maxnodes or get_node_budget(),
+        pin_cpus=args.pincpus,
+        use_forkserver=args.forkserver,
         enable_coverage=args.coverage,
         args=passon_args,
         combined_logs_len=args.combinedlogslen,
@@ -321,7 +366,7 @@ def main():
         runs_ci=args.ci,
     )
 
-def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, runs_ci):
+def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, max_nodes=None, pin_cpus=False, use_forkserver=False, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, runs_ci):
     args = args or []
 
     # Warn if bvaultd is already running (unix only)
@@ -347,6 +392,14 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
     else:
         coverage = None
 
+    forkserver = None
+    if use_forkserver:
+        # Start it now, so that it imports the framework while the cache is built
+        try:
+            forkserver = start_forkserver(tests_dir)
+        except OSError as e:
+            print("%sWARNING!%s Could not start the forkserver, running the tests in new interpreters: %s" % (BOLD[1], BOLD[0], e))
+
     if len(test_list) > 1 and jobs > 1:
         # Populate cache
         try:
@@ -355,9 +408,18 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
             sys.stdout.buffer.write(e.output)
             raise
 
+    # Start the tests that took longest last time first, to finish as early as possible
+    timings = Timings("%s/test/%s" % (build_dir, TIMING_FILE))
+    test_list = timings.sort_by_expected_duration(test_list)
+
+    logging.debug("Running up to %d tests with up to %s bvaultd processes at once%s" % (jobs, max_nodes or "any number of", ", each test on its own CPUs" if pin_cpus else ""))
+
     #Run Tests
     job_queue = TestHandler(
         num_tests_parallel=jobs,
+        max_nodes=max_nodes,
+        pin_cpus=pin_cpus,
+        forkserver=forkserver,
         tests_dir=tests_dir,
         tmpdir=tmpdir,
         test_list=test_list,
@@ -398,6 +460,9 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
                 break
 
     print_results(test_results, max_len_name, (int(time.time() - start_time)))
+    print(job_queue.schedule_summary())
+
+    timings.save_timings(job_queue.completed)
 
     if coverage:
         coverage.report_rpc_coverage()
@@ -439,14 +504,117 @@ def print_results(test_results, max_len_name, runtime):
     results += "Runtime: %s s\n" % (runtime)
     print(results)
 
+def get_available_memory():
+    """Return the memory available for new processes in bytes, or None if unknown."""
+    try:
+        with open('/proc/meminfo', encoding='utf8') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def get_usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def get_node_budget():
+    """Return how many bvaultd processes can run at once on this machine.
+
+    Nodes under test are idle much of the time, so allow two per CPU, as far
+    as the available memory allows."""
+    budget = 2 * len(get_usable_cpus())
+    memory = get_available_memory()
+    if memory is not None:
+        budget = min(budget, memory // NODE_MEMORY_ESTIMATE)
+    return max(1, budget)
+
+def get_test_num_nodes(script):
+    """Return the num_nodes a test script sets in set_test_params(), or 1 if it can't be found."""
+    try:
+        with open(script, encoding='utf8') as f:
+            match = re.search(r"self\.num_nodes\s*=\s*(\d+)", f.read())
+    except OSError:
+        return 1
+    return int(match.group(1)) if match else 1
+
+def start_forkserver(tests_dir):
+    """Start the multiprocessing forkserver with the test framework imported. Returns its context."""
+    from multiprocessing import forkserver
+    # The forkserver takes its sys.path from this process
+    if tests_dir not in sys.path:
+        sys.path.insert(0, tests_dir)
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    forkserver.ensure_running()
+    return context
+
+def run_forked_test(script, args, stdout_path, stderr_path):
+    """Run a test script as `python3 script args` would, with its output going to the given files.
+
+    This runs in a child of the forkserver, which has the framework imported."""
+    for fd, path in ((1, stdout_path), (2, stderr_path)):
+        log_fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        os.dup2(log_fd, fd)
+        os.close(log_fd)
+    sys.argv = [script] + args
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name='__main__')
+
+class ForkedTest():
+    """A test script run in a child of the forkserver.
+
+    Provides the part of the subprocess.Popen interface that TestHandler uses.
+    The child's exit code is that of the script, or minus the signal that
+    killed it."""
+
+    def __init__(self, context, script, args, stdout_path, stderr_path):
+        self.process = context.Process(target=run_forked_test, args=(script, args, stdout_path, stderr_path), name=os.path.basename(script))
+        self.process.start()
+        self.pid = self.process.pid
+        self.returncode = None
+        self._wait_lock = threading.Lock()
+
+    def wait(self):
+        # Only one thread at a time may collect the exit status
+        with self._wait_lock:
+            self.process.join()
+            self.returncode = self.process.exitcode
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
 class TestHandler:
     """
     Trigger the test scripts passed in via the list.
+
+    Tests are started in list order, as long as fewer than num_tests_parallel
+    are running and their nodes fit in max_nodes. A test that doesn't fit is
+    passed over for a later one that does, unless nothing is running.
+
+    Tests are run in new interpreters, or forked from the forkserver of the
+    given multiprocessing context, except for FRESH_INTERPRETER_SCRIPTS.
     """
 
-    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, timeout_duration):
+    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, timeout_duration, max_nodes=None, pin_cpus=False, forkserver=None):
         assert num_tests_parallel >= 1
         self.num_jobs = num_tests_parallel
+        self.max_nodes = max_nodes or float('inf')
+        self.num_nodes_running = 0
+        self.num_nodes = {test: get_test_num_nodes(tests_dir + test.split()[0]) for test in test_list}
+        # CPUs that are not pinned to a running test, if pinning
+        self.free_cpus = get_usable_cpus() if pin_cpus else None
+        self.forkserver = forkserver
         self.tests_dir = tests_dir
         self.tmpdir = tmpdir
         self.timeout_duration = timeout_duration
@@ -454,61 +622,134 @@ class TestHandler:
         self.flags = flags
         self.num_running = 0
         self.jobs = []
+        # Worker slots, to see which tests ran one after the other
+        self.free_slots = list(range(num_tests_parallel))
+        # (name, status, slot, start time, end time) of each finished test
+        self.completed = []
+        # (process, exit time) of each test that has exited, put there by one
+        # waiter thread per process
+        self.exited = queue.Queue()
+        # The number of nodes and the CPUs of each running test, by process
+        self.resources = {}
+
+    def _pop_next_test(self):
+        """Remove and return the first test whose nodes fit in the budget, if any."""
+        for i, test in enumerate(self.test_list):
+            if self.num_running == 0 or self.num_nodes_running + self.num_nodes[test] <= self.max_nodes:
+                return self.test_list.pop(i)
+        return None
+
+    def _pin_cpus(self, proc, num_nodes):
+        """Pin a test to CPUs of its own, one per node if enough are free. Returns the CPUs."""
+        cpus = self.free_cpus[:max(1, num_nodes)]
+        if not cpus:
+            return []
+        try:
+            # The test's nodes are started later, and inherit the affinity
+            os.sched_setaffinity(proc.pid, cpus)
+        except OSError:
+            return []  # e.g. the test exited already
+        del self.free_cpus[:len(cpus)]
+        return cpus
+
+    def _wait_for_exit(self, proc):
+        proc.wait()
+        self.exited.put((proc, time.time()))
+
+    def _interrupt_timed_out(self, now):
+        """Interrupt the running tests that reached the timeout. Returns when the next one will."""
+        next_timeout = float('inf')
+        for (name, slot, start_time, proc, testdir, log_out, log_err) in self.jobs:
+            if now - start_time > self.timeout_duration:
+                # In travis, timeout individual tests (to stop tests hanging and not providing useful output).
+                proc.send_signal(signal.SIGINT)
+            else:
+                next_timeout = min(next_timeout, start_time + self.timeout_duration)
+        return next_timeout
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
             # Add tests
+            test = self._pop_next_test()
+            if test is None:
+                break
             self.num_running += 1
-            test = self.test_list.pop(0)
+            slot = self.free_slots.pop(0)
             portseed = len(self.test_list)
             portseed_arg = ["--portseed={}".format(portseed)]
-            log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
-            log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
+            script_args = test_argv[1:] + self.flags + portseed_arg + tmpdir_arg
+            if self.forkserver and test_argv[0] not in FRESH_INTERPRETER_SCRIPTS:
+                # The forked test opens the files by name
+                log_stdout = tempfile.NamedTemporaryFile()
+                log_stderr = tempfile.NamedTemporaryFile()
+                proc = ForkedTest(self.forkserver, self.tests_dir + test_argv[0], script_args, log_stdout.name, log_stderr.name)
+            else:
+                log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
+                log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
+                proc = subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + script_args,
+                                        universal_newlines=True,
+                                        stdout=log_stdout,
+                                        stderr=log_stderr)
+            num_nodes = self.num_nodes[test]
+            self.num_nodes_running += num_nodes
+            cpus = self._pin_cpus(proc, num_nodes) if self.free_cpus is not None else []
+            self.resources[proc] = (num_nodes, cpus)
+            threading.Thread(target=self._wait_for_exit, args=(proc,), daemon=True).start()
             self.jobs.append((test,
+                              slot,
                               time.time(),
-                              subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
+                              proc,
                               testdir,
                               log_stdout,
                               log_stderr))
         if not self.jobs:
             raise IndexError('pop from empty list')
         dot_count = 0
+        next_dot = time.time() + .5
         while True:
-            # Return first proc that finishes
-            time.sleep(.5)
-            for job in self.jobs:
-                (name, start_time, proc, testdir, log_out, log_err) = job
-                if int(time.time() - start_time) > self.timeout_duration:
-                    # In travis, timeout individual tests (to stop tests hanging and not providing useful output).
-                    proc.send_signal(signal.SIGINT)
-                if proc.poll() is not None:
-                    log_out.seek(0), log_err.seek(0)
-                    [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
-                    log_out.close(), log_err.close()
-                    if proc.returncode == TEST_EXIT_PASSED and stderr == "":
-                        status = "Passed"
-                    elif proc.returncode == TEST_EXIT_SKIPPED:
-                        status = "Skipped"
-                    else:
-                        status = "Failed"
-                    self.num_running -= 1
-                    self.jobs.remove(job)
-                    clearline = '\r' + (' ' * dot_count) + '\r'
-                    print(clearline, end='', flush=True)
-                    dot_count = 0
-                    return TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr
-            print('.', end='', flush=True)
-            dot_count += 1
+            # Return first proc that finishes, as soon as it does. Wake up
+            # every half second to show progress, and as soon as a running
+            # test reaches the timeout. The timeout is checked on every
+            # wake-up, so tests finishing in quick succession can't delay it.
+            now = time.time()
+            next_timeout = self._interrupt_timed_out(now)
+            if now >= next_dot:
+                print('.', end='', flush=True)
+                dot_count += 1
+                next_dot = now + .5
+            try:
+                finished_proc, end_time = self.exited.get(timeout=min(next_dot, next_timeout) - now)
+            except queue.Empty:
+                continue
+            job = next(job for job in self.jobs if job[3] is finished_proc)
+            (name, slot, start_time, proc, testdir, log_out, log_err) = job
+            log_out.seek(0), log_err.seek(0)
+            [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
+            log_out.close(), log_err.close()
+            if proc.returncode == TEST_EXIT_PASSED and stderr == "":
+                status = "Passed"
+            elif proc.returncode == TEST_EXIT_SKIPPED:
+                status = "Skipped"
+            else:
+                status = "Failed"
+            self.num_running -= 1
+            self.jobs.remove(job)
+            self.free_slots.append(slot)
+            num_nodes, cpus = self.resources.pop(proc)
+            self.num_nodes_running -= num_nodes
+            if cpus:
+                self.free_cpus = sorted(self.free_cpus + cpus)
+            self.completed.append((name, status, slot, start_time, end_time))
+            clearline = '\r' + (' ' * dot_count) + '\r'
+            print(clearline, end='', flush=True)
+            return TestResult(name, status, int(end_time - start_time)), testdir, stdout, stderr
 
     def kill_and_join(self):
         """Send SIGKILL to all jobs and block until all have ended."""
-        procs = [i[2] for i in self.jobs]
+        procs = [i[3] for i in self.jobs]
 
         for proc in procs:
             proc.kill()
@@ -516,6 +757,62 @@ class TestHandler:
         for proc in procs:
             proc.wait()
 
+    def schedule_summary(self):
+        """Describe how well the tests were spread over the workers.
+
+        The critical path is the chain of tests run by the worker that finished
+        last. Idle worker time is the time workers spent without a test to run
+        between the first test starting and the last one finishing."""
+        if not self.completed:
+            return ""
+        first_start = min(start for _, _, _, start, _ in self.completed)
+        last_end = max(end for _, _, _, _, end in self.completed)
+        busy = sum(end - start for _, _, _, start, end in self.completed)
+        last_slot = max(self.completed, key=lambda c: c[4])[2]
+        critical_path = [c for c in self.completed if c[2] == last_slot]
+        idle = self.num_jobs * (last_end - first_start) - busy
+        longest = max(self.completed, key=lambda c: c[4] - c[3])
+        summary = "Critical path: %s (%.1f s)\n" % (" -> ".join(c[0] for c in critical_path), critical_path[-1][4] - critical_path[0][3])
+        summary += "Longest test: %s (%.1f s)\n" % (longest[0], longest[4] - longest[3])
+        summary += "Idle worker time: %.1f s (%d%% of %d workers)\n" % (idle, 100 * idle / (self.num_jobs * (last_end - first_start) or 1), self.num_jobs)
+        return summary
+
+
+class Timings():
+    """
+    Durations of earlier test runs, used to schedule the longest tests first.
+
+    Durations are stored in a json file, by test name (including arguments),
+    and updated for every test that passes.
+    """
+
+    def __init__(self, timing_file):
+        self.timing_file = timing_file
+        self.existing_timings = self.load_timings()
+
+    def load_timings(self):
+        try:
+            with open(self.timing_file, encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def sort_by_expected_duration(self, test_list):
+        """Return test_list ordered longest-expected-first.
+
+        Tests without a recorded duration go first, in their original order,
+        since they could be long."""
+        return sorted(test_list, key=lambda test: -self.existing_timings.get(test, float('inf')))
+
+    def save_timings(self, completed):
+        for name, status, _, start, end in completed:
+            if status == "Passed":
+                self.existing_timings[name] = round(end - start, 1)
+        tmp_file = "%s.%d.tmp" % (self.timing_file, os.getpid())
+        with open(tmp_file, 'w', encoding="utf8") as f:
+            json.dump(self.existing_timings, f, indent=0, sort_keys=True)
+        os.replace(tmp_file, self.timing_file)
+
 
 class TestResult():
     def __init__(self, name, status, time):